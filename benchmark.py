@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+""" Benchmarks for itoa.py
+
+    Run against synthetic exports so the numbers can be shared and
+    compared between changes.
+"""
+
+import io
+import os
+import csv
+import json
+import time
+import operator
+import random
+import platform
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+
+import itoa
+
+################## SYNTHETIC EXPORTS ##########################################
+FIRST_NAMES = ["John", "Jane", "Robert", "Mary", "Michael", "Linda", "David", "Susan", "James", "Karen",
+               "William", "Lisa", "Richard", "Nancy", "Thomas", "Betty", "Daniel", "Sandra", "Paul", "Ashley",
+               "Mark", "Emily", "Steven", "Donna", "Andrew", "Michelle", "Joshua", "Carol", "Kevin", "Amanda",
+               "Brian", "Melissa", "George", "Deborah", "Timothy", "Rebecca", "Jason", "Laura", "Ryan", "Sarah"]
+ACCENTED    = {"Jose": "José", "Zoe": "Zoë", "Rene": "René", "Nunez": "Núñez", "Andre": "André"}
+SYLLABLES   = ["al", "ba", "ber", "cal", "dan", "del", "ford", "gar", "ham", "hol", "ing", "kin", "lan",
+               "ley", "mar", "mil", "mor", "nor", "oak", "per", "ran", "rich", "ros", "sand", "son", "stan",
+               "ter", "ton", "van", "wal", "well", "win", "wood", "yor", "zel", "bro", "cor", "fin", "gil", "har"]
+CITIES      = ["Denver", "Boulder", "Golden", "Durango", "Fruita", "Salida", "Gunnison", "Lyons", "Evergreen"]
+STATES      = ["CO"] * 8 + ["UT", "WY", "NM", "KS"]
+
+class SyntheticMembers(object):
+    """ Deterministic fake members for benchmark exports
+
+        Person k always has the same name, email, phone and address for a
+        given seed, so IMBA rows can duplicate AMBA rows without keeping
+        the AMBA rows in memory.
+    """
+    AMBA_ID = 10000000 # AMBA membership ids start here
+    IMBA_ID = 50000000 # IMBA membership ids that aren't duplicates start here
+
+    def __init__(self, seed=1, dirty=0.0):
+        self._seed  = seed
+        self._dirty = dirty # Proportion of rows with quoted, padded, accented or mixed case fields
+
+    def person(self, k):
+        rnd = random.Random(self._seed * 1000003 + k)
+        first = rnd.choice(FIRST_NAMES + list(ACCENTED.values()))
+        last = "".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))).capitalize()
+        return {
+            "first": first,
+            "last": last,
+            "email": "%s.%s%s@example.com" % (first.lower(), last.lower(), k % 1000),
+            "phone": "%03d-555-%04d" % (rnd.choice([303, 720, 970]), k % 10000),
+            "street": "%s %s St" % (rnd.randint(1, 9999), rnd.choice(SYLLABLES).capitalize()),
+            "city": rnd.choice(CITIES),
+            "state": rnd.choice(STATES),
+            "postal": "8%04d" % rnd.randint(0, 9999),
+        }
+
+    def dirty(self, rnd, person):
+        """ Make a copy of person with the kind of mess real exports have
+        """
+        person = dict(person)
+        if rnd.random() < self._dirty:
+            person["street"] += ", Apt %s" % rnd.randint(1, 99) # Quoted comma
+        if rnd.random() < self._dirty / 10:
+            person["street"] += "\nc/o %s" % person["last"]   # Quoted newline
+        if rnd.random() < self._dirty:
+            person["first"] = "  %s " % person["first"].upper()
+            person["last"] = person["last"].lower() + " "
+        if rnd.random() < self._dirty:
+            person["email"] = " " + person["email"].upper()
+        return person
+
+    def write_amba(self, fname, rows):
+        rnd = random.Random(self._seed)
+        with open(fname, 'w', newline='', encoding='utf-8-sig') as fd:
+            writer = csv.writer(fd)
+            writer.writerow(itoa.AMBAMembers.REQUIRED_FIELDS)
+            for k in range(rows):
+                p = self.dirty(rnd, self.person(k))
+                writer.writerow([str(self.AMBA_ID + k), p["first"], p["last"], p["email"], p["phone"],
+                                 rnd.choice(["Yes", "No"]), p["street"], p["city"], p["state"], p["postal"],
+                                 "1/%s/2020" % rnd.randint(1, 28), "50", "0"])
+
+    def write_imba(self, fname, rows, amba_rows, dup_id=0.0, dup_email=0.0, dup_name=0.0, dup_fuzzy=0.0,
+                   terms=(0.5, 0.3, 0.2), truth=None):
+        """ IMBA export where the given proportions of rows duplicate an AMBA
+            member by membership id, email (case changed), name (case and
+            accents changed) or, for fuzzy matching, a name with a typo but
+            the same phone and address. terms is the (regular, auto yearly,
+            auto monthly) mix. Every duplicate made is listed in the truth
+            file when there is one.
+        """
+        rnd = random.Random(self._seed + 1)
+        reg, yearly = terms[0], terms[0] + terms[1]
+        with open(fname, 'w', newline='', encoding='utf-8') as fd, \
+                open(truth or os.devnull, 'w', newline='') as truth_fd:
+            writer = csv.writer(fd)
+            writer.writerow(itoa.IMBAMembers.REQUIRED_FIELDS)
+            truth_writer = csv.writer(truth_fd)
+            truth_writer.writerow(TRUTH_HEADER)
+            for j in range(rows):
+                member_id = str(self.IMBA_ID + j)
+                p = self.person(amba_rows + j) # Someone who isn't an AMBA member
+
+                r = rnd.random()
+                k = rnd.randrange(amba_rows) if amba_rows else 0
+                kind = None
+                if r < dup_id:
+                    member_id = str(self.AMBA_ID + k)
+                    kind = "id"
+                elif r < dup_id + dup_email:
+                    p["email"] = self.person(k)["email"].upper()
+                    kind = "email"
+                elif r < dup_id + dup_email + dup_name:
+                    a = self.person(k)
+                    p["first"], p["last"] = a["first"].upper(), a["last"].lower()
+                    for plain, accented in ACCENTED.items():
+                        p["first"] = p["first"].replace(accented.upper(), plain.upper())
+                    kind = "name"
+                elif r < dup_id + dup_email + dup_name + dup_fuzzy:
+                    a = self.person(k)
+                    for field in ("first", "phone", "street", "city", "state", "postal"):
+                        p[field] = a[field]
+                    at = rnd.randrange(1, len(a["last"])) # One letter mistyped
+                    letter = rnd.choice([c for c in "abcdefghijklmnopqrstuvwxyz" if c != a["last"][at]])
+                    p["last"] = a["last"][:at] + letter + a["last"][at + 1:]
+                    kind = "fuzzy"
+                if kind is not None:
+                    truth_writer.writerow([member_id, str(self.AMBA_ID + k), kind])
+                p = self.dirty(rnd, p)
+
+                t = rnd.random()
+                term, auto = ("Year", "No") if t < reg else ("Year", "Yes") if t < yearly else ("Month", "Yes")
+                start = "%s/%s/%s" % (rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(2015, 2024))
+                writer.writerow(["C%s" % j, p["first"], p["last"], p["street"], p["city"], p["state"],
+                                 p["postal"], p["email"], p["phone"], member_id,
+                                 rnd.choice(["Individual", "Family"]), term, auto,
+                                 start, start, "12/31/2025", start, rnd.choice(["35", "50", "5"]),
+                                 "Current", "0"])
+
+TRUTH_HEADER = ["IMBA Membership ID", "AMBA Membership ID", "Kind"]
+
+def read_truth(fname):
+    """ { <IMBA membership id>: (<AMBA membership id>, <kind>), ... } from
+        the truth file of write_imba
+    """
+    with open(fname, newline='') as fd:
+        rows = csv.reader(fd)
+        next(rows)
+        return dict((imba_id, (amba_id, kind)) for imba_id, amba_id, kind in rows)
+
+def write_amba_file(fname, rows, seed=1):
+    """ Clean AMBA export, plain enough for the legacy parser
+    """
+    SyntheticMembers(seed=seed).write_amba(fname, rows)
+
+
+################## PARSER #####################################################
+def legacy_parse_amba(fname):
+    """ The AMBA parser before it was moved onto the streaming csv reader,
+        kept here as the baseline for bench_parse
+    """
+    with open(fname, 'r') as fd:
+        data = fd.read()
+    if data[:1] == '\ufeff':
+        data = data[1:]
+
+    fields  = dict()
+    members = dict()
+    emails  = dict()
+    index   = itoa.MemberIndex()
+    for line, entry in enumerate(data.split("\n")):
+        if len(entry) == 0:
+            continue
+        entry = entry.split(",")
+        if line == 0:
+            for i, field in enumerate(entry):
+                fields[field.strip()] = i
+            continue
+
+        am = itoa.AMBAMember()
+        am.first_name = entry[fields["First name"]].strip().capitalize()
+        am.last_name = entry[fields["Last name"]].strip().capitalize()
+        am.street = entry[fields["Street Address"]].strip()
+        am.city = entry[fields["City"]].strip().capitalize()
+        am.state = entry[fields["State"]].strip().upper()
+        am.postal_code = entry[fields["Postal Code"]].strip()
+        am.email = entry[fields["Email"]].strip().lower()
+        am.phone = entry[fields["Phone"]].strip()
+        am.membership_id = entry[fields["Membership ID"]].strip()
+        am.member_bundle_id = entry[fields["Parent Membership ID"]].strip()
+        members[am.membership_id] = am
+        emails[am.email] = am.membership_id
+        index.add(am)
+    return members
+
+def measure(func, *args):
+    """ Return (seconds, peak traced bytes) for func(*args), timed and
+        traced in separate calls so tracing doesn't skew the time
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        func(*args)
+        seconds = time.perf_counter() - start
+
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak
+
+def bench_parse(rows, directory):
+    """ Compare the streaming AMBA parser with the legacy read/split parser
+    """
+    fname = os.path.join(directory, "amba.csv")
+    write_amba_file(fname, rows)
+    size = os.path.getsize(fname)
+
+    print(" Parsing %s AMBA rows (%.1f MB)" % (rows, size / 1e6))
+    for name, func in (("legacy", legacy_parse_amba), ("streaming", itoa.AMBAMembers)):
+        seconds, peak = measure(func, fname)
+        print("   + %-10s %8.3f s %10.0f rows/s %8.1f MB/s  peak %7.1f MB" \
+                % (name, seconds, rows / seconds, size / seconds / 1e6, peak / 1e6))
+
+
+def bench_workers(rows, directory, max_workers):
+    """ Parse time for 1 to max_workers processes, chunked parsing kicks in
+        for every file here since the chunk size is lowered to 1 MB
+    """
+    fname = os.path.join(directory, "amba.csv")
+    if not os.path.isfile(fname):
+        write_amba_file(fname, rows)
+    itoa.Members.CHUNK_SIZE = 1 << 20
+
+    print(" Parsing %s AMBA rows on 1 to %s workers (%s cores)" % (rows, max_workers, os.cpu_count()))
+    base = None
+    for workers in range(1, max_workers + 1):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            itoa.AMBAMembers(fname, workers=workers)
+            seconds = time.perf_counter() - start
+        base = base or seconds
+        print("   + %2s workers %8.3f s %10.0f rows/s  speedup %4.2fx" % (workers, seconds, rows / seconds, base / seconds))
+
+
+################## PIPELINE STAGES ############################################
+def bench_stages(amba_file, imba_file, directory, workers=1, fuzzy=None, trace=False, truth_file=None):
+    """ Run the whole pipeline once and report the stages itoa.metrics
+        recorded, program output goes to directory/itoa.log. With fuzzy
+        matching and the generator's truth file, also how many fuzzy
+        matches were wrong
+    """
+    itoa.metrics.reset()
+    if trace:
+        tracemalloc.start()
+    with open(os.path.join(directory, "itoa.log"), 'w') as log, contextlib.redirect_stdout(log):
+        amba = itoa.AMBAMembers(amba_file, workers=workers)
+        imba = itoa.IMBAMembers(imba_file, workers=workers)
+        all_members = itoa.AllMembers(amba, imba, directory, fuzzy=fuzzy)
+    if trace:
+        tracemalloc.stop()
+
+    print(" %-40s %9s %9s %11s %11s %11s" % ("stage", "wall s", "cpu s", "rss peak MB", "rss +MB", "traced MB"))
+    for result in itoa.metrics.stages:
+        print("   + %-36s %9.3f %9.3f %11s %11s %11s" % (result["stage"], result["wall_s"], result["cpu_s"], \
+                result.get("process_peak_rss_mb", "-"), result.get("rss_growth_mb", "-"),
+                result.get("traced_peak_mb", "-")))
+
+    results = {
+        "amba_rows": len(amba.members),
+        "imba_rows": len(imba.members),
+        "duplicates": len(all_members.matches),
+        "stages": itoa.metrics.stages,
+    }
+    if fuzzy is not None and truth_file is not None:
+        results["fuzzy"] = fuzzy_accuracy(all_members.matches, read_truth(truth_file), imba.members)
+    return results
+
+def fuzzy_accuracy(matches, truth, imba_members):
+    """ Fuzzy matches checked against the duplicates the generator made
+        - false_positive_rate: wrong fuzzy matches over the IMBA members
+          that duplicate nobody
+        - recall: mistyped duplicates fuzzy matching found
+    """
+    fuzzy = dict((imba_id, amba_id) for imba_id, (rule, amba_id) in matches.items() if rule == "fuzzy")
+    wrong = [imba_id for imba_id, amba_id in fuzzy.items() if truth.get(imba_id, (None,))[0] != amba_id]
+    distinct = sum(1 for imba_id in imba_members if imba_id not in truth)
+    typos = [imba_id for imba_id, (amba_id, kind) in truth.items() if kind == "fuzzy" and imba_id in imba_members]
+    found = sum(1 for imba_id in typos if fuzzy.get(imba_id) == truth[imba_id][0])
+
+    accuracy = {
+        "matches": len(fuzzy),
+        "false_positives": len(wrong),
+        "false_positive_rate": len(wrong) / max(distinct, 1),
+        "mistyped": len(typos),
+        "recall": found / max(len(typos), 1),
+    }
+    print(" Fuzzy matches %s, %s wrong: false positive rate %.3f%% of %s distinct members, "
+          "%s of %s mistyped duplicates found (recall %.1f%%)" % (len(fuzzy), len(wrong),
+          100 * accuracy["false_positive_rate"], distinct, found, len(typos), 100 * accuracy["recall"]))
+    return accuracy
+
+
+################## PARTITIONED FUZZY MATCHING ##################################
+def bench_fuzzy_workers(amba_file, imba_file, directory, max_workers, fuzzy=0.85, key="state"):
+    """ Fuzzy matching partitioned by key on 1 to max_workers processes,
+        every worker count must find the same matches
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        amba = itoa.AMBAMembers(amba_file)
+        imba = itoa.IMBAMembers(imba_file)
+
+    print(" Fuzzy matching partitioned by %s (threshold %s)" % (key, fuzzy))
+    base = None
+    expected = None
+    for workers in range(1, max_workers + 1):
+        itoa.metrics.reset()
+        with contextlib.redirect_stdout(io.StringIO()):
+            matches = itoa.AllMembers(amba, imba, directory, fuzzy=fuzzy, partition=key, workers=workers).matches
+        stages = dict((stage["stage"], stage["wall_s"]) for stage in itoa.metrics.stages)
+        seconds = stages["AllMembers._duplicate_members"]
+        base = base or seconds
+        print("   + %2s workers %8.3f s  speedup %4.2fx  %s duplicates" % (workers, seconds, base / seconds, len(matches)))
+        if expected is None:
+            expected = matches
+        elif matches != expected:
+            differ = set(expected.items()).symmetric_difference(matches.items())
+            raise SystemExit(" Matches on %s workers differ from 1 worker for %s members, e.g. %s" \
+                    % (workers, len(differ), sorted(differ)[:5]))
+
+
+################## OUT-OF-CORE MATCHING #########################################
+def in_memory_matches(amba_file, imba_file, directory):
+    amba = itoa.AMBAMembers(amba_file)
+    imba = itoa.IMBAMembers(imba_file)
+    return itoa.AllMembers(amba, imba, directory).matches
+
+def out_of_core_matches(amba_file, imba_file, directory, budget_mb):
+    with tempfile.TemporaryDirectory(dir=directory) as spill:
+        matcher = itoa.PartitionedMatcher(itoa.AMBAMembers.stream(amba_file), itoa.IMBAMembers.stream(imba_file),
+                                          spill, budget_mb=budget_mb, amba_size=os.path.getsize(amba_file))
+        return matcher.matches
+
+def bench_partition(amba_file, imba_file, directory, budget_mb=1):
+    """ Duplicates found out of core must be exactly the ones the in-memory
+        index finds, compared here along with time and peak memory
+    """
+    results = dict()
+    print(" Matching in memory and out of core (budget %s MB)" % budget_mb)
+    for name, func, args in (("in memory", in_memory_matches, (amba_file, imba_file, directory)),
+                             ("out of core", out_of_core_matches, (amba_file, imba_file, directory, budget_mb))):
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = func(*args)
+        seconds, peak = measure(func, *args)
+        print("   + %-12s %8.3f s  peak %7.1f MB  %s duplicates" % (name, seconds, peak / 1e6, len(results[name])))
+
+    if results["in memory"] != results["out of core"]:
+        differ = set(results["in memory"].items()).symmetric_difference(results["out of core"].items())
+        raise SystemExit(" Out-of-core matches differ from the in-memory ones for %s members, e.g. %s" \
+                % (len(differ), sorted(differ)[:5]))
+    print("   + Both found the same %s matches" % len(results["in memory"]))
+
+
+################## MEMBERS ####################################################
+class DictMember(object):
+    """ A member stored in an instance __dict__ behind properties, as
+        members were before AMBAMember/IMBAMember moved to __slots__
+    """
+    def __init__(self):
+        for field in FIELDS:
+            setattr(self, "_" + field, None)
+
+def _dict_member_property(field):
+    def setter(self, value):
+        setattr(self, "_" + field, value)
+    return property(operator.attrgetter("_" + field), setter)
+
+FIELDS = itoa.IMBAMember.fields()
+for _field in FIELDS:
+    setattr(DictMember, _field, _dict_member_property(_field))
+
+def bench_members(rows):
+    """ Memory per member and field access time, dict based vs slotted
+    """
+    print(" Building %s IMBA members" % rows)
+    values = [["%s%s" % (field, i) for field in FIELDS] for i in range(rows)]
+    for name, cls in (("dict", DictMember), ("slots", itoa.IMBAMember)):
+        # Field values are created up front and shared by both, so only
+        # the member objects themselves are traced
+        members = [None] * rows
+        tracemalloc.start()
+        for i in range(rows):
+            member = cls()
+            for field, value in zip(FIELDS, values[i]):
+                setattr(member, field, value)
+            members[i] = member
+        size = tracemalloc.get_traced_memory()[0] / rows
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        for member in members:
+            for field in FIELDS:
+                getattr(member, field)
+        seconds = time.perf_counter() - start
+        print("   + %-6s %5.0f bytes/member %8.1f MB per million %7.3f s to read every field" \
+                % (name, size, size, seconds))
+
+
+################## MATCH SERVICE ##############################################
+def bench_service(amba_file, imba_file, fuzzy=None, queries=10000):
+    """ Latency of single duplicate checks against a resident MatchService,
+        one query per IMBA row
+    """
+    service = itoa.MatchService(amba_file, imba_file, fuzzy=fuzzy)
+    imba = itoa.IMBAMembers(imba_file)
+    requests = [dict((field, getattr(member, field)) for field in ("membership_id", "email", "first_name",
+                     "last_name", "phone", "postal_code")) for member in imba.members.values()][:queries]
+
+    latencies = list()
+    duplicates = 0
+    for request in requests:
+        start = time.perf_counter()
+        duplicates += service.handle(request)["duplicate"]
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print(" %s queries, %s duplicates (fuzzy %s)" % (len(latencies), duplicates, fuzzy))
+    for name, seconds in (("p50", latencies[len(latencies) // 2]), ("p99", latencies[len(latencies) * 99 // 100]),
+                          ("max", latencies[-1])):
+        print("   + %s %8.3f ms" % (name, seconds * 1000))
+
+
+################## MAIN #######################################################
+def terms(value):
+    """ argparse type for the reg,yearly,monthly term mix, e.g. 0.5,0.3,0.2
+    """
+    mix = [float(part) for part in value.split(",")]
+    if len(mix) != 3 or abs(sum(mix) - 1) > 1e-6:
+        raise argparse.ArgumentTypeError("expected 3 proportions adding up to 1, e.g. 0.5,0.3,0.2")
+    return mix
+
+def generate(args, directory):
+    """ Write amba.csv, imba.csv and imba_truth.csv, the duplicates made,
+        into directory, returns the paths of the exports
+    """
+    amba_file = os.path.join(directory, "amba.csv")
+    imba_file = os.path.join(directory, "imba.csv")
+    synthetic = SyntheticMembers(seed=args.seed, dirty=args.dirty)
+
+    start = time.perf_counter()
+    synthetic.write_amba(amba_file, args.rows)
+    synthetic.write_imba(imba_file, args.imba_rows or args.rows, args.rows, dup_id=args.dup_id, \
+            dup_email=args.dup_email, dup_name=args.dup_name, dup_fuzzy=args.dup_fuzzy, terms=args.terms,
+            truth=os.path.join(directory, "imba_truth.csv"))
+    print(" Generated %s and %s in %.1f s" % (amba_file, imba_file, time.perf_counter() - start))
+    return amba_file, imba_file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark itoa.py on synthetic exports')
+    parser.add_argument('bench', action='store', nargs='*', metavar='BENCH',
+                       help='What to run: generate (exports only), stages (time each pipeline stage, '
+                            'the default), parse (compare parsers), workers (parser scaling), '
+                            'members (member memory), service (match service latency), partition '
+                            '(out-of-core matching against in memory), fuzzy-workers (partitioned '
+                            'fuzzy matching scaling)')
+    parser.add_argument('-n', '--rows', dest='rows', action='store', type=int, default=100000,
+                       help='Rows in the AMBA export, and the IMBA export unless --imba-rows is given')
+    parser.add_argument('--imba-rows', dest='imba_rows', action='store', type=int, default=None,
+                       help='Rows in the IMBA export')
+    parser.add_argument('--dup-id', dest='dup_id', action='store', type=float, default=0.1,
+                       help='Proportion of IMBA rows with an AMBA membership id (default 0.1)')
+    parser.add_argument('--dup-email', dest='dup_email', action='store', type=float, default=0.1,
+                       help='Proportion of IMBA rows with an AMBA email (default 0.1)')
+    parser.add_argument('--dup-name', dest='dup_name', action='store', type=float, default=0.05,
+                       help='Proportion of IMBA rows with an AMBA name (default 0.05)')
+    parser.add_argument('--dup-fuzzy', dest='dup_fuzzy', action='store', type=float, default=0.02,
+                       help='Proportion of IMBA rows with an AMBA name mistyped, and its phone and address '
+                            '(default 0.02)')
+    parser.add_argument('--terms', dest='terms', action='store', type=terms, default=[0.5, 0.3, 0.2],
+                       help='Regular, auto-renew yearly and auto-renew monthly mix (default 0.5,0.3,0.2)')
+    parser.add_argument('--dirty', dest='dirty', action='store', type=float, default=0.05,
+                       help='Proportion of rows with quoted, padded or mixed case fields (default 0.05)')
+    parser.add_argument('--seed', dest='seed', action='store', type=int, default=1,
+                       help='Random seed, the same seed always generates the same exports')
+    parser.add_argument('-d', '--directory', dest='directory', action='store', default=None,
+                       help='Keep the generated exports and outputs here instead of a temporary directory')
+    parser.add_argument('-w', '--workers', dest='workers', action='store', type=int, default=1,
+                       help='Parser workers for the stages run, most workers to try for the workers and '
+                            'fuzzy-workers runs')
+    parser.add_argument('--fuzzy', dest='fuzzy', action='store', type=itoa.fuzzy_threshold, nargs='?', const=0.85,
+                       metavar='THRESHOLD', help='Include fuzzy matching in the stages and service runs')
+    parser.add_argument('--partition-key', dest='partition_key', action='store', default='state',
+                       choices=sorted(itoa.PARTITION_KEYS), help='Key of the fuzzy-workers run (default state)')
+    parser.add_argument('--budget', dest='budget', action='store', type=int, default=1, metavar='MB',
+                       help='Memory budget of the partition run, small to force splits (default 1)')
+    parser.add_argument('--trace', dest='trace', action='store_true',
+                       help='Trace Python allocations per stage with tracemalloc (slow)')
+    parser.add_argument('-o', '--output', dest='output', action='store', default='benchmark.json',
+                       help='Machine readable results of the stages run (default benchmark.json)')
+
+    args = parser.parse_args()
+    args.bench = args.bench or ['stages']
+    for bench in args.bench:
+        if bench not in ('generate', 'stages', 'parse', 'workers', 'members', 'service', 'partition',
+                         'fuzzy-workers'):
+            parser.error("unknown benchmark %s" % bench)
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.directory or tmp
+        os.makedirs(directory, exist_ok=True)
+
+        if set(args.bench).intersection(('generate', 'stages', 'service', 'partition', 'fuzzy-workers')):
+            amba_file, imba_file = generate(args, directory)
+
+        if 'stages' in args.bench:
+            results = bench_stages(amba_file, imba_file, directory, workers=args.workers, \
+                    fuzzy=args.fuzzy, trace=args.trace, truth_file=os.path.join(directory, "imba_truth.csv"))
+            results["settings"] = dict((name, value) for name, value in vars(args).items() \
+                    if name not in ("bench", "output", "directory"))
+            results["python"] = platform.python_version()
+            results["cpus"] = os.cpu_count()
+            results["date"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            with open(args.output, 'w') as fd:
+                json.dump(results, fd, indent=2)
+            print(" Results written to %s" % args.output)
+
+        if 'parse' in args.bench:
+            bench_parse(args.rows, tmp)
+        if 'workers' in args.bench:
+            bench_workers(args.rows, tmp, max(args.workers, 2))
+        if 'members' in args.bench:
+            bench_members(args.rows)
+        if 'service' in args.bench:
+            bench_service(amba_file, imba_file, fuzzy=args.fuzzy)
+        if 'partition' in args.bench:
+            bench_partition(amba_file, imba_file, directory, budget_mb=args.budget)
+        if 'fuzzy-workers' in args.bench:
+            bench_fuzzy_workers(amba_file, imba_file, directory, max(args.workers, 2), fuzzy=args.fuzzy or 0.85,
+                                key=args.partition_key)
@@ -1,18 +1,609 @@
 #!/usr/bin/env python3
 
+import io
+import bz2
 import os
+import re
 import csv
 import sys
+import gzip
+import gc
+import lzma
+import json
+import mmap
+import pickle
+import sqlite3
 import time
+import datetime
+import heapq
+import queue
 import shutil
+import difflib
+import hashlib
+import operator
+import cProfile
 import argparse
+import atexit
+import tempfile
+import http.server
+import urllib.parse
+import threading
+import functools
+import contextlib
+import tracemalloc
+import multiprocessing
+import concurrent.futures
+import unicodedata
+
+try:
+    import fcntl
+    import resource
+except ImportError: # Not available on Windows, no reflinks or memory metrics there
+    fcntl = None
+    resource = None
+
+################## METRICS ####################################################
+class Metrics(object):
+    """ Timings and counters for each stage of a run
+        - wall_s / cpu_s: wall clock and process CPU seconds, CPU time of
+          stages running at the same time (both parsers with --workers)
+          overlaps, and doesn't include worker processes
+        - process_peak_rss_mb: peak resident memory of the whole process
+          so far, a running maximum, not this stage's
+        - rss_growth_mb: how much the stage raised that peak, 0 when it
+          stayed under the peak of an earlier stage
+        - traced_peak_mb: peak Python allocations during the stage, only
+          while tracemalloc is tracing (--trace-memory). Stages running at
+          the same time share one peak
+        - Anything the stage adds with count(), e.g. rows and duplicates
+    """
+    def __init__(self):
+        self._stages = list()
+        self._local  = threading.local() # Stack of open stages per thread
+
+    @property
+    def stages(self):
+        return self._stages
+
+    def reset(self):
+        self._stages = list()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stack = self._local.__dict__.setdefault("stack", list())
+        result = {"stage": name}
+        stack.append(result)
+
+        tracing = tracemalloc.is_tracing()
+        if tracing: # An inner stage resets the peak again, it hands its peak back on exit
+            if len(stack) > 1:
+                stack[-2]["traced_peak_mb"] = self._traced_peak(stack[-2])
+            tracemalloc.reset_peak()
+        rss = self._max_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield result
+        finally:
+            stack.pop()
+            result["wall_s"] = round(time.perf_counter() - wall, 4)
+            result["cpu_s"] = round(time.process_time() - cpu, 4)
+            if rss is not None:
+                peak = self._max_rss()
+                result["process_peak_rss_mb"] = round(peak, 1)
+                result["rss_growth_mb"] = round(peak - rss, 1)
+            if tracing and tracemalloc.is_tracing():
+                result["traced_peak_mb"] = self._traced_peak(result)
+                if stack:
+                    stack[-1]["traced_peak_mb"] = max(self._traced_peak(stack[-1]), result["traced_peak_mb"])
+            self._stages.append(result)
+
+    @staticmethod
+    def _max_rss():
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    @staticmethod
+    def _traced_peak(result):
+        """ Peak since the last reset, or the higher peak already recorded
+            for the stage
+        """
+        return max(round(tracemalloc.get_traced_memory()[1] / 1e6, 1), result.get("traced_peak_mb", 0))
+
+    def count(self, name, value):
+        """ Add a counter to the innermost open stage of this thread
+        """
+        stack = self._local.__dict__.get("stack")
+        if stack:
+            stack[-1][name] = value
+
+    def save(self, fname, **run):
+        """ Write the stages and anything about the run to a JSON file
+        """
+        with open(fname, 'w') as fd:
+            json.dump({"run": run, "stages": self._stages}, fd, indent=2)
+
+metrics = Metrics() # Shared by every stage of a run
+
+def timed(method):
+    """ Record a metrics stage named <class>.<method> for each call
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with metrics.stage("%s.%s" % (type(self).__name__, method.__name__)):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+################## LOGGING ####################################################
+class Log(object):
+    """ Leveled progress output of a run
+        - QUIET only shows errors, INFO the progress and summary lines,
+          VERBOSE also the per-row detail
+        - Per-row detail (each new member, each fuzzy match) goes to a
+          buffered detail file rather than the console, with a copy of
+          everything else for context
+        - progress() gives a periodic line with rows per second for long
+          loops
+        Console lines are printed when they are logged, so they follow
+        any redirect of sys.stdout.
+    """
+    QUIET, INFO, VERBOSE = 0, 1, 2
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self):
+        self.level   = self.INFO
+        self._detail = None # Detail file, None when there isn't one
+        atexit.register(self.close) # Keep what's buffered when a run exits early
+
+    @property
+    def details(self): # True if detail lines go anywhere, to skip formatting them otherwise
+        return self._detail is not None or self.level >= self.VERBOSE
+
+    def open(self, fname):
+        """ Write detail lines, and a copy of the rest, to fname
+        """
+        self.close()
+        self._detail = open(fname, 'w', buffering=self.BUFFER_SIZE)
+
+    def close(self):
+        if self._detail is not None:
+            self._detail.close()
+            self._detail = None
+
+    def error(self, message=""):
+        print(message)
+        if self._detail is not None:
+            self._detail.write(message + "\n")
+
+    def info(self, message=""):
+        if self.level >= self.INFO:
+            print(message)
+        if self._detail is not None:
+            self._detail.write(message + "\n")
+
+    def detail(self, message=""):
+        if self.level >= self.VERBOSE:
+            print(message)
+        if self._detail is not None:
+            self._detail.write(message + "\n")
+
+    def progress(self, what, interval=5.0):
+        return Progress(self, what, interval)
+
+log = Log() # Shared by every stage of a run
+
+class Progress(object):
+    """ '   + <what>: <rows> rows, <rate> rows/s' at most every interval
+        seconds, callers only need to update() every few thousand rows
+    """
+    EVERY = 0x3FFF # update() mask: rows & EVERY == 0
+
+    def __init__(self, log, what, interval=5.0):
+        self._log      = log
+        self._what     = what
+        self._interval = interval
+        self._start    = self._last = time.perf_counter()
+
+    def update(self, rows):
+        now = time.perf_counter()
+        if now - self._last >= self._interval:
+            self._last = now
+            self._log.info("   + %s: %s rows, %.0f rows/s" % (self._what, rows, rows / (now - self._start)))
+
+
+################## NORMALIZATION ##############################################
+# Rules used to compare names and emails across the AMBA and IMBA exports.
+# Both member classes go through these so a key built from one file can be
+# looked up in an index built from the other.
+_DROP_CHARS = re.compile(r"['\u2019.]")  # O'Neil -> oneil, Jr. -> jr
+_PUNCTUATION = re.compile(r"[^\w\s]")   # Everything else becomes a space
+
+@functools.lru_cache(maxsize=65536)
+def normalize_text(value):
+    """ Lower case, strip accents and punctuation, collapse whitespace
+    """
+    if not value.isascii():
+        value = unicodedata.normalize("NFKD", value)
+        value = "".join(c for c in value if not unicodedata.combining(c))
+    value = _DROP_CHARS.sub("", value.lower())
+    value = _PUNCTUATION.sub(" ", value)
+    return " ".join(value.split())
+
+def normalize_email(value):
+    return value.strip().lower()
+
+def normalize_name(first_name, last_name):
+    """ Full name key, empty if neither part has any letters left
+    """
+    return (normalize_text(first_name) + " " + normalize_text(last_name)).strip()
+
+
+class MemberIndex(object):
+    """ Hash index of members by each of the keys used to find duplicates
+        { <rule>: { <key>: <member_id>, ... }, ... }
+
+        Rules are checked in order so a member is reported against the
+        strongest key it matches on.
+    """
+    RULES = ("id", "email", "name")
+
+    def __init__(self):
+        self._keys = dict((rule, dict()) for rule in self.RULES)
+        self._more = dict((rule, dict()) for rule in self.RULES) # { <rule>: { <key>: [<member_id>, ...] } } Later members sharing a key
+
+    def __len__(self):
+        return len(self._keys["id"])
+
+    @staticmethod
+    def keys(member):
+        """ The (rule, key) pairs for a member, empty keys are skipped
+        """
+        keys = list()
+        if member.membership_id:
+            keys.append(("id", member.membership_id))
+        email = normalize_email(member.email)
+        if email:
+            keys.append(("email", email))
+        name = normalize_name(member.first_name, member.last_name)
+        if name:
+            keys.append(("name", name))
+        return keys
+
+    def add(self, member):
+        self.add_keys(member.membership_id, self.keys(member))
+
+    def add_keys(self, member_id, keys):
+        """ Index member_id under keys already worked out by keys()
+        """
+        for rule, key in keys:
+            if key in self._keys[rule]:
+                self._more[rule].setdefault(key, list()).append(member_id)
+            else:
+                self._keys[rule][key] = member_id
+
+    def dump(self):
+        """ { <rule>: (<first member ids>, <later member ids>), ... } the
+            index as plain dicts, for a snapshot
+        """
+        return dict((rule, (self._keys[rule], self._more[rule])) for rule in self.RULES)
+
+    @classmethod
+    def load(cls, state):
+        """ Index from what dump() returned
+        """
+        index = cls()
+        for rule, (keys, more) in state.items():
+            index._keys[rule] = keys
+            index._more[rule] = more
+        return index
+
+    def lookup(self, rule, key):
+        """ All member ids indexed under a key, first indexed first
+        """
+        member_id = self._keys[rule].get(key)
+        if member_id is None:
+            return []
+        return [member_id] + self._more[rule].get(key, [])
+
+    def match(self, member):
+        """ Return (rule, member_id) for the first indexed member that
+            shares a key with member, None if there isn't one
+        """
+        for rule, key in self.keys(member):
+            member_id = self._keys[rule].get(key)
+            if member_id is not None:
+                return rule, member_id
+        return None
+
+
+################## DATES ######################################################
+DATE_FORMATS = ("%m/%d/%Y", "%Y-%m-%d", "%m-%d-%Y", "%m/%d/%y") # Tried in order after the M/D/YYYY fast path
+
+@functools.lru_cache(maxsize=1 << 16)
+def parse_date(value):
+    """ Day number (date.toordinal()) of a date, None when blank or not a
+        date. Exports only hold a few thousand distinct dates, so each is
+        parsed once and then comes from the cache.
+    """
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        month, day, year = value.split("/")
+        if len(year) == 4:
+            return datetime.date(int(year), int(month), int(day)).toordinal()
+    except ValueError:
+        pass
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt).toordinal()
+        except ValueError:
+            pass
+    return None
+
+@functools.lru_cache(maxsize=1 << 16)
+def format_date(days):
+    """ M/D/YYYY for a day number, the format of the exports
+    """
+    date = datetime.date.fromordinal(days)
+    return "%s/%s/%s" % (date.month, date.day, date.year)
+
+@functools.lru_cache(maxsize=1 << 16)
+def add_years(days, years):
+    """ The same day years later, Feb 29 becomes Feb 28 when the year
+        isn't a leap year
+    """
+    date = datetime.date.fromordinal(days)
+    try:
+        return date.replace(year=date.year + years).toordinal()
+    except ValueError: # Feb 29
+        return date.replace(year=date.year + years, day=28).toordinal()
+
+def renewal_day(member):
+    """ Day number an IMBA member renews on, None if its dates are missing
+        - Monthly members: a year after the current start date
+        - Others: the end date
+    """
+    if member.member_term == "month":
+        start = parse_date(member.curr_start)
+        return add_years(start, 1) if start is not None else None
+    return parse_date(member.end_date)
+
+def today():
+    return datetime.date.today().toordinal()
+
+def expiry_window(days):
+    """ (today, today + days) as day numbers, None when days is None
+    """
+    return None if days is None else (today(), today() + days)
+
+
+################## COMPRESSED FILES ###########################################
+COMPRESSION = { # <extension>: (<module>, <magic bytes>, <options when writing>)
+    "gz":  (gzip, b"\x1f\x8b", {"compresslevel": 6}),
+    "bz2": (bz2,  b"BZh", {}),
+    "xz":  (lzma, b"\xfd7zXZ\x00", {}),
+}
+
+def compression(fname):
+    """ Compression of a file from its first bytes, None for a plain file
+    """
+    with open(fname, 'rb') as fd:
+        magic = fd.read(6)
+    for extension, (module, signature, options) in COMPRESSION.items():
+        if magic.startswith(signature):
+            return extension
+    return None
+
+def open_export(fname):
+    """ Open an export as text for csv.reader, .gz, .bz2 and .xz files are
+        decompressed on the fly in a background thread
+    """
+    extension = compression(fname)
+    if extension is None:
+        return open(fname, newline='', encoding='utf-8-sig')
+    raw = BackgroundReader(fname, COMPRESSION[extension][0])
+    return io.TextIOWrapper(io.BufferedReader(raw, BackgroundReader.BLOCK_SIZE), encoding='utf-8-sig', newline='')
+
+def open_output(fname, compress=None, buffering=-1):
+    """ Open an output file as text, compressed when compress is one of
+        the COMPRESSION extensions
+    """
+    if compress is None:
+        return open(fname, 'w', newline='', buffering=buffering)
+    module, signature, options = COMPRESSION[compress]
+    return module.open(fname, 'wt', newline='', **options)
+
+
+class BackgroundReader(io.RawIOBase):
+    """ Raw stream of a compressed file, decompressed a few blocks ahead
+        of the reader in a background thread. zlib, bz2 and lzma release
+        the GIL while they work, so decompression overlaps with parsing.
+    """
+    BLOCK_SIZE = 1 << 20
+    AHEAD      = 8 # Blocks decompressed ahead of the reader
+
+    def __init__(self, fname, module):
+        super().__init__()
+        self._queue  = queue.Queue(self.AHEAD)
+        self._block  = memoryview(b"")
+        self._eof    = False
+        self._stop   = threading.Event() # Reader closed, stop decompressing
+        self._thread = threading.Thread(target=self._decompress, args=(fname, module), daemon=True)
+        self._thread.start()
+
+    def _decompress(self, fname, module):
+        try:
+            with module.open(fname, 'rb') as fd:
+                while not self._stop.is_set():
+                    block = fd.read(self.BLOCK_SIZE)
+                    self._put(block)
+                    if not block: # b"" marks the end for the reader
+                        return
+        except Exception as err: # Raised again in the reader
+            self._put(err)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full: # Reader is behind, or gone
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._block:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._block = memoryview(item)
+        count = min(len(buffer), len(self._block))
+        buffer[:count] = self._block[:count]
+        self._block = self._block[count:]
+        return count
+
+    def close(self):
+        self._stop.set()
+        super().close()
+
+
+################## VALIDATION #################################################
+class Quarantine(object):
+    """ Rows that can't be used are set aside instead of stopping the run
+        - Each rejected row is written to the quarantine file with its
+          export, line number and the reason, then its original fields.
+          The file is only created once a row is rejected
+        - The run is aborted when more than max_rejects rows are rejected,
+          or more than max_rate of the rows of one export
+        - Without a quarantine file rejected rows are only logged
+        - A row rejected again, when an export is read twice, only counts
+          once
+    """
+    HEADER = ["File", "Line", "Reason"]
+
+    def __init__(self, max_rejects=1000, max_rate=0.05):
+        self.max_rejects = max_rejects # None for no limit
+        self.max_rate    = max_rate    # None for no limit
+        self._lock   = threading.Lock() # Both exports are parsed at once with workers
+        self._fname  = None
+        self._fd     = None
+        self._writer = None
+        self._count  = 0
+        self._seen   = set() # { (<file>, <line>), ... } Rows already rejected
+        atexit.register(self.close)
+
+    @property
+    def count(self): # Rows rejected since the quarantine file was opened
+        return self._count
+
+    def open(self, fname):
+        """ Quarantine rejected rows to fname from now on
+        """
+        self.close()
+        self._fname = fname
+        self._count = 0
+        self._seen  = set()
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+        self._fd = self._writer = self._fname = None
+
+    def reject(self, fname, line, reason, entry):
+        """ Set one row aside, abort if there are too many
+        """
+        with self._lock:
+            if (fname, line) in self._seen:
+                return
+            self._seen.add((fname, line))
+            self._count += 1
+            if self._fname is not None:
+                if self._writer is None:
+                    self._fd = open(self._fname, 'w', newline='', encoding='utf-8')
+                    self._writer = csv.writer(self._fd)
+                    self._writer.writerow(self.HEADER)
+                self._writer.writerow([fname, line, reason] + entry)
+            log.detail("   + Rejected %s line %s: %s" % (fname, line, reason))
+            if self.max_rejects is not None and self._count > self.max_rejects:
+                self._abort("More than %s rows rejected" % self.max_rejects)
+
+    def check(self, fname, rows, rejected):
+        """ Once an export is parsed, abort if too much of it was rejected
+        """
+        if not rejected:
+            return
+        total = rows + rejected
+        log.info("   + %s of %s rows rejected%s" % (rejected, total, " to %s" % self._fname if self._fname else ""))
+        if self.max_rate is not None and rejected > self.max_rate * total:
+            self._abort("%s of the %s rows of %s rejected" % (rejected, total, fname))
+
+    def _abort(self, why):
+        fname = self._fname
+        self.close()
+        log.error("!!!%s, stopping. Rejected rows are in %s!!!" % (why, fname or "the log"))
+        sys.exit(1)
+
+quarantine = Quarantine() # Shared by every export of a run
+
 
 ################## COMMON TO BOTH AMBA AND IMBA MEMBERS #######################
+# Decoders from a raw CSV value to a member field
+def decode_text(value):
+    return value.strip()
+
+def decode_lower(value):
+    return value.strip().lower()
+
+def decode_upper(value):
+    return value.strip().upper()
+
+def decode_capitalized(value):
+    return value.strip().capitalize()
+
+
 class Members(object):
     """ A generic member class used for both AMBA and IMBA members
+        - hashes: hash each row for incremental runs
+        - workers: parse large files in chunks on this many processes
+        - pool: process pool to parse chunks on, shared between files
+        - cache: SnapshotCache of members already parsed from the same export
+
+        Only the EAGER fields the match rules need are decoded while
+        parsing. Each member keeps the raw values of its other FIELDS and
+        decodes them the first time they are used, e.g. when it is
+        exported, so duplicates and AMBA members mostly never do.
     """
-    def __init__(self):
-        pass
+    CHUNK_SIZE = 32 << 20 # Bytes per chunk when parsing in parallel
+    FIELDS     = dict()   # { <member attribute>: (<export column>, <decoder>), ... }
+    EAGER      = ("membership_id", "email", "first_name", "last_name") # Decoded while parsing
+
+    def __init__(self, members_file, hashes=False, workers=1, pool=None, cache=None):
+        self._members_file = members_file
+        self._members = dict() # { <member_id>: Member, ... }
+        self._fields  = dict() # { <field>: <index>, ... }
+        self._emails  = dict() # { <email>: <member_id>, ... }
+        self._index   = MemberIndex()
+        self._hashes  = dict() # { <member_id>: <row hash>, ... }
+        self._hash    = hashes
+        self._workers = workers
+        self._pool    = pool
+        self._cache   = cache # SnapshotCache to load the members from, or save them to after parsing
+        self._decoders = dict()  # { <member attribute>: (<index>, <decoder>), ... } Fields decoded on first use
+        self._eager    = tuple() # (<column index>, <decoder>) of each EAGER field
+        self._project  = None    # Picks the raw values of the fields decoded on first use out of an entry
+        self._width    = 0       # Fields an entry needs for every mapped column
+        self._reader   = None    # csv reader of the members file, for line numbers
+        self._rejected = list()  # [(<line>, <reason>, <entry>), ...] Rows set aside
+        self._rows     = 0       # Rows parsed, not counting the rejected ones
 
     @property
     def members(self): # Dictionary used to store all members { <member_id>: Member, ... }
@@ -21,47 +612,415 @@ class Members(object):
     @property
     def emails(self): # Dictionary used to look up members by their email { <email>: <member_id>, ... }
         return self._emails
+
+    @property
+    def index(self): # MemberIndex by id, email and name, built while parsing
+        return self._index
+
+    @property
+    def hashes(self): # Dictionary of row content hashes { <member_id>: <hash>, ... }, empty unless requested
+        return self._hashes
+
+    @classmethod
+    def stream(cls, members_file):
+        """ Parse a members file one member at a time, in file order,
+            without keeping them
+        """
+        members = cls.__new__(cls) # Only what _parse_entry needs, no file parse
+        Members.__init__(members, members_file)
+        rows = 0
+        for entry in members._checked_entries():
+            rows += 1
+            yield members._parse_entry(entry)
+        quarantine.check(members_file, rows, len(members._rejected))
+
+    @staticmethod
+    def _hash_entry(entry):
+        """ Short stable hash of a raw CSV row, used to spot changed rows
+            between runs
+        """
+        return hashlib.blake2b("\x1f".join(entry).encode(), digest_size=8).hexdigest()
+
+    def _parse_entries(self):
+        """ Parse every entry of the members file and add it, in file order
+            - Serially from the streaming reader, or
+            - In chunks on a process pool when there are workers to spare
+              and the file is big enough to split
+        """
+        if self._cache is not None and self._cache.load(self):
+            return
+
+        size = os.path.getsize(self._members_file)
+        if self._workers > 1 and size > self.CHUNK_SIZE and compression(self._members_file) is None:
+            parsed = self._parse_chunks(size)
+        else: # Compressed files can't be split, they are read as one stream
+            parsed = (self._parse_row(entry) for entry in self._checked_entries())
+
+        progress = log.progress("Parsed %s" % os.path.basename(self._members_file))
+        rows = 0
+        for rows, (member, keys, row_hash) in enumerate(parsed, 1):
+            self._add_member(member, keys, row_hash)
+            if not rows & Progress.EVERY:
+                progress.update(rows)
+        self._rows = rows
+        quarantine.check(self._members_file, rows, len(self._rejected))
+
+        if self._cache is not None:
+            self._cache.store(self)
+
+    def snapshot(self):
+        """ Everything parsing built, as plain data for a SnapshotCache:
+            a few long strings, one per column of values joined with
+            \x1f, which pickle and split back far faster than one object
+            per value
+        """
+        members = self._members.values()
+        return {
+            "fields":  self._fields,
+            "members": [_pack(getattr(member, name) for member in members) for name in self.member_class().fields()],
+            "emails":  [_pack(self._emails), _pack(self._emails.values())],
+            "index":   dict((rule, [_pack(keys), _pack(keys.values()), more]) \
+                                for rule, (keys, more) in self._index.dump().items()),
+            "hashes":  [_pack(self._hashes), _pack(self._hashes.values())],
+            "rows":     self._rows,
+            "rejected": self._rejected,
+        }
+
+    def restore(self, snapshot):
+        """ Rebuild from snapshot() instead of parsing
+        """
+        columns = [_unpack(values) for values in snapshot["members"]]
+        ids = columns[self.member_class().fields().index("membership_id")]
+        self._fields  = snapshot["fields"]
+        self._members = dict(zip(ids, map(self.member_class(), *columns)))
+        self._emails  = dict(zip(*map(_unpack, snapshot["emails"])))
+        self._index   = MemberIndex.load(dict((rule, (dict(zip(_unpack(keys), _unpack(ids))), more)) \
+                                for rule, (keys, ids, more) in snapshot["index"].items()))
+        self._hashes  = dict(zip(*map(_unpack, snapshot["hashes"])))
+        for line, reason, entry in snapshot["rejected"]: # Quarantined again like a parse would
+            self._reject(line, reason, entry)
+        self._rows = snapshot["rows"]
+        quarantine.check(self._members_file, self._rows, len(self._rejected))
+
+    def _check(self, entry):
+        """ Why an entry can't be used, None if it can
+        """
+        if len(entry) < self._width:
+            return "Row has %s fields, expected at least %s" % (len(entry), self._width)
+        return None
+
+    def _reject(self, line, reason, entry):
+        self._rejected.append((line, reason, entry))
+        quarantine.reject(self._members_file, line, reason, entry)
+
+    def _checked_entries(self):
+        """ Entries of the members file that pass _check, the others are
+            quarantined with their line number
+        """
+        for entry in self._read_members_file():
+            reason = self._check(entry)
+            if reason is None:
+                yield entry
+            else:
+                self._reject(self._reader.line_num, reason, entry)
+
+    def _parse_row(self, entry):
+        """ (member, index keys, row hash) for one entry
+        """
+        member = self._parse_entry(entry)
+        return member, MemberIndex.keys(member), self._hash_entry(entry) if self._hash else None
+
+    def _parse_chunks(self, size):
+        """ Split the file on record boundaries and parse the pieces on the
+            process pool, results come back in file order
+        """
+        start = self._read_header()
+        chunks = max(self._workers, (size - start) // self.CHUNK_SIZE)
+        bounds = record_boundaries(self._members_file, start, chunks)
+        log.info(" - Parsing %s in %s chunks on %s workers." % (self._members_file, len(bounds) - 1, self._workers))
+
+        pool = self._pool or concurrent.futures.ProcessPoolExecutor(self._workers)
+        try:
+            tasks = [(type(self), self._members_file, self._fields, self._hash, bounds[i], bounds[i + 1]) \
+                        for i in range(len(bounds) - 1)]
+            line = 1 # The header
+            for packed, rejected, lines in pool.map(_parse_chunk, tasks):
+                for row_line, reason, entry in rejected:
+                    self._reject(line + row_line, reason, entry)
+                line += lines
+                yield from _unpack_chunk(self.member_class(), packed)
+        finally:
+            if pool is not self._pool:
+                pool.shutdown()
+
+    def _read_header(self):
+        """ Map fields from the header and return the byte offset of the
+            first entry after it
+        """
+        with open(self._members_file, 'rb') as fd:
+            header = fd.readline()
+            self._map_fields(next(csv.reader([header.decode('utf-8-sig')])))
+            return fd.tell()
+
+    def _add_member(self, member, keys, row_hash):
+        self._members[member.membership_id] = member # Members indexed here by membership id
+        self._emails[member.email] = member.membership_id # A list to look up members by their email
+        self._index.add_keys(member.membership_id, keys)
+        if row_hash is not None:
+            self._hashes[member.membership_id] = row_hash
    
+    def _read_members_file(self):
+        """ Stream the entries of a CSV export one row at a time
+            - A byte order mark at the start of the file is dropped
+            - The first row is used to map fields and isn't returned
+            - Quoted fields may contain commas and newlines
+            - Empty rows are skipped
+            - Compressed files are decompressed as they are read
+        """
+        with open_export(self._members_file) as csvfile:
+            reader = self._reader = csv.reader(csvfile, delimiter=',')
+            for entry in reader:
+                if not entry: # Skip empty entries
+                    continue
+                if not self._fields: # First line is used to map fields
+                    self._map_fields(entry)
+                    continue # Skip to next entry after the fields are mapped
+                yield entry
+
     def _map_fields(self, entry):
         """ Map fields from the first line of a CSV file
         """
         
-        # First validate that the required fields exist
-        for field in self._required_fields:
+        # First validate that the required fields exist, only the ones
+        # matching needs stop the run, the others are left blank
+        critical = self.critical_fields()
+        for field in self.REQUIRED_FIELDS:
             if not field in entry:
-                print("!!!Missing field -> %s in export file %s!!!" % (field, self._members_file))
-                sys.exit()
-        print(" - Required fields in %s have been validated." % (self._members_file))
+                if field in critical:
+                    log.error("!!!Missing field -> %s in export file %s!!!" % (field, self._members_file))
+                    sys.exit(1)
+                log.info(" - Field %s missing from %s, left blank." % (field, self._members_file))
+        log.info(" - Required fields in %s have been validated." % (self._members_file))
 
         # Map expected fields to their index locations 
         for index, field in enumerate(entry):
             self._fields[field.strip()] = index
+        self._map_decoders()
+
+    @classmethod
+    def critical_fields(cls):
+        """ Columns of the EAGER fields, an export can't be used without
+            them
+        """
+        return [cls.FIELDS[name][0] for name in cls.EAGER]
+
+    def _map_decoders(self):
+        """ Where this file's columns are for the member fields
+            - EAGER fields are decoded straight from the entry by
+              _parse_entry, self._eager holds their column indexes and
+              decoders
+            - The other FIELDS are decoded on first use from the raw
+              values a member keeps of just those columns, the rest of the
+              entry isn't kept
+        """
+        self._eager = tuple((self._fields[self.FIELDS[name][0]], self.FIELDS[name][1]) for name in self.EAGER)
+        lazy = [name for name in self.FIELDS if name not in self.EAGER]
+        present = [name for name in lazy if self.FIELDS[name][0] in self._fields]
+        columns = [self._fields[self.FIELDS[name][0]] for name in present]
+        if len(columns) > 1:
+            self._project = operator.itemgetter(*columns)
+        else: # itemgetter of one column doesn't return a tuple
+            self._project = lambda entry: tuple(entry[column] for column in columns)
+        for name in lazy:
+            self._decoders[name] = (None, self.FIELDS[name][1]) # Missing column, decoded as blank
+        for position, name in enumerate(present):
+            self._decoders[name] = (position, self.FIELDS[name][1])
+        self._width = max([index for index, decode in self._eager] + columns) + 1
+
+def _pack(values):
+    """ [<count>, <values joined with \x1f>], the count tells one empty
+        value from none. Values are kept as a list when one of them holds
+        \x1f itself
+    """
+    values = list(values)
+    return [len(values), _join(values)]
+
+def _unpack(packed):
+    count, joined = packed
+    return _split(joined) if count else []
+
+def _join(values):
+    """ values joined with \x1f, or the list of values if the join
+        couldn't be split back
+    """
+    joined = "\x1f".join(values)
+    return joined if joined.count("\x1f") == len(values) - 1 else values
+
+def _split(joined):
+    return joined.split("\x1f") if isinstance(joined, str) else joined
+
+
+def record_boundaries(fname, start, chunks):
+    """ Byte offsets that split fname from start into about chunks pieces
+        [start, ..., <file size>]. Each offset is just past a newline that
+        ends a record, so every piece holds whole records.
+
+        Quotes follow the csv reader's rules: a quote only starts a quoted
+        field at the start of a field, anywhere else (12" Oak St) it is
+        text. Only lines with a quote can change whether the file is
+        inside a quoted field, so the other lines are skipped over.
+    """
+    size = os.path.getsize(fname)
+    targets = [start + (size - start) * i // chunks for i in range(1, chunks)]
+    bounds = [start]
+
+    def split(end): # A record ends at end, it's the boundary of the targets up to there
+        if targets and targets[0] <= end:
+            bounds.append(end)
+            while targets and targets[0] <= end:
+                targets.pop(0)
+
+    with open(fname, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pos = start     # Start of a line
+        quoted = False  # Inside a quoted field at pos
+        while targets and pos < size:
+            quote = data.find(b'"', pos)
+            line = size if quote < 0 else max(pos, data.rfind(b"\n", pos, quote) + 1) # Start of the quote's line
+            # Lines from pos to line have no quotes, every one of them
+            # ends a record unless they are inside a quoted field
+            while not quoted and targets and targets[0] < line:
+                newline = data.find(b"\n", max(targets[0], pos) - 1, line)
+                if newline < 0:
+                    break
+                split(newline + 1)
+            if quote < 0:
+                break
+            end = data.find(b"\n", quote)
+            end = size if end < 0 else end + 1
+            quoted = _ends_quoted(data[line:end], quoted)
+            if not quoted:
+                split(end)
+            pos = end
+
+    if bounds[-1] != size:
+        bounds.append(size)
+    return bounds
+
+def _ends_quoted(line, quoted):
+    """ True if a line that starts inside a quoted field when quoted ends
+        inside one, read the way the csv reader does
+    """
+    pos = 0
+    while True:
+        if quoted: # Up to the closing quote, "" is a quote in the field
+            while True:
+                close = line.find(b'"', pos)
+                if close < 0:
+                    return True
+                if line[close + 1:close + 2] != b'"':
+                    break
+                pos = close + 2
+            pos = close + 1
+            quoted = False
+        else: # Start of a field
+            if line[pos:pos + 1] == b'"':
+                quoted = True
+                pos += 1
+                continue
+        comma = line.find(b",", pos) # Anything after is text up to the next field
+        if comma < 0:
+            return False
+        pos = comma + 1
+
+def _parse_chunk(task):
+    """ Parse the entries of one chunk in a worker process
+
+        Members are sent back packed into one string each, fields then row
+        hash then index keys joined with \\x1f (a list for the rare member
+        with \\x1f in a field), since pickling plain strings costs far
+        less than pickling member objects. Rejected rows
+        come back with their line in the chunk, and the chunk's line count
+        so the parent can number them in the file.
+    """
+    cls, fname, fields, hashes, start, end = task
+    members = cls.__new__(cls) # Only what _parse_row needs, no file parse
+    members._members_file = fname
+    members._fields = fields
+    members._hash = hashes
+    members._decoders = dict()
+    members._map_decoders()
+
+    with open(fname, 'rb') as fd:
+        fd.seek(start)
+        data = fd.read(end - start).decode('utf-8')
+
+    names = cls.member_class().fields()
+    packed = list()
+    rejected = list() # [(<line in the chunk>, <reason>, <entry>), ...]
+    reader = csv.reader(io.StringIO(data, newline=''))
+    for entry in reader:
+        if not entry:
+            continue
+        reason = members._check(entry)
+        if reason is not None:
+            rejected.append((reader.line_num, reason, entry))
+            continue
+        member, keys, row_hash = members._parse_row(entry)
+        keys = dict(keys)
+        values = [getattr(member, name) for name in names]
+        values.append(row_hash or "")
+        values.extend(keys.get(rule, "") for rule in MemberIndex.RULES)
+        packed.append(_join(values))
+    return packed, rejected, data.count("\n")
+
+def _unpack_chunk(cls, packed):
+    """ Turn the strings from _parse_chunk back into
+        [(member, index keys, row hash), ...]
+    """
+    count = len(cls.fields())
+    for row in packed:
+        values = _split(row)
+        member = cls(*values[:count])
+        keys = [(rule, key) for rule, key in zip(MemberIndex.RULES, values[count + 1:]) if key]
+        yield member, keys, values[count] or None
 
 
 ################## AMBA MEMBERS ###############################################
 class AMBAMembers(Members): # Inherite from Members
-    def __init__(self, members_file):
-        self._members_file = members_file
-        self._members = dict() # { <member_id>: IMBAMember, ... }
-        self._fields  = dict() # { <field>: <index>, ... }
-        self._emails  = dict() # { <email>: <member_id>, ... }
-        
-        # Fields we expect to be in the AMBA members file
-        self._required_fields = [ 
-                'Membership ID', \
-                'First name', \
-                'Last name', \
-                'Email', \
-                'Phone', \
-                'IMBA Member', \
-                'Street Address', \
-                'City', \
-                'State', \
-                'Postal Code', \
-                'Latest Contribution Date', \
-                'Latest Contribution Amount', \
-                'Parent Membership ID', \
-            ]
+    # Fields we expect to be in the AMBA members file
+    REQUIRED_FIELDS = [
+        'Membership ID', \
+        'First name', \
+        'Last name', \
+        'Email', \
+        'Phone', \
+        'IMBA Member', \
+        'Street Address', \
+        'City', \
+        'State', \
+        'Postal Code', \
+        'Latest Contribution Date', \
+        'Latest Contribution Amount', \
+        'Parent Membership ID', \
+    ]
+
+    FIELDS = {
+        "first_name":       ("First name", decode_capitalized),
+        "last_name":        ("Last name", decode_capitalized),
+        "street":           ("Street Address", decode_text),
+        "city":             ("City", decode_capitalized),
+        "state":            ("State", decode_upper),
+        "postal_code":      ("Postal Code", decode_text),
+        "email":            ("Email", decode_lower),
+        "phone":            ("Phone", decode_text),
+        "membership_id":    ("Membership ID", decode_text),
+        "member_bundle_id": ("Parent Membership ID", decode_text),
+        "contrib_date":     ("Latest Contribution Date", decode_text),
+        "contrib_amount":   ("Latest Contribution Amount", decode_text),
+    }
+
+    def __init__(self, members_file, hashes=False, workers=1, pool=None, cache=None):
+        super().__init__(members_file, hashes=hashes, workers=workers, pool=pool, cache=cache)
 
         # Parse and populate
         self._parse_members_file() 
@@ -71,198 +1030,168 @@ class AMBAMembers(Members): # Inherite from Members
         """ Make this public so that it can be used for writting
             out CSV files
         """
-        return self._required_fields
+        return self.REQUIRED_FIELDS
     
+    @timed
     def _parse_members_file(self): 
         """  - Parse a AMBA member file
              - Create and populate AMBAMember objects
              - Add AMBAMember objects to AMBAMembers.members
              - Add each member email to AMBAMembers.emails
         """
-        print(" Importing AMBA members from %s." % self._members_file)
-        with open(self._members_file, 'r') as fd:
-            data = fd.read()
+        log.info(" Importing AMBA members from %s." % self._members_file)
+        self._parse_entries()
+        log.info(" - %s AMBA members extracted from file %s."  % (len(self._members), self._members_file))
+        metrics.count("rows", len(self._members))
 
-        if data[:1] == '\ufeff': # Strip this off the front 
-            data = data[1:]
+    @staticmethod
+    def member_class():
+        return AMBAMember
 
-        # Extract each entry and map it's fields to a member object
-        for index, entry in enumerate(data.split("\n")):
-            if len(entry) == 0: # Skip empty entries
-                continue
-
-            entry = entry.split(",") # Comma separated fields
-            if index == 0: # First line is used to map fields
-                self._map_fields(entry)
-                continue # Skip to next entry after the fields are mapped
-
-            am = AMBAMember()
-            am.first_name = entry[self._fields["First name"]].strip().capitalize()
-            am.last_name = entry[self._fields["Last name"]].strip().capitalize()
-
-            am.street = entry[self._fields["Street Address"]].strip()
-            am.city = entry[self._fields["City"]].strip().capitalize()
-            am.state = entry[self._fields["State"]].strip().upper()
-            am.postal_code = entry[self._fields["Postal Code"]].strip()
-            
-            am.email = entry[self._fields["Email"]].strip().lower()
-            am.phone = entry[self._fields["Phone"]].strip()
-            
-            am.membership_id = entry[self._fields["Membership ID"]].strip()
-            am.member_bundle_id = entry[self._fields["Parent Membership ID"]].strip()
-            
-            self._members[am.membership_id] = am # Members indexed here by membership id
-            self._emails[am.email] = am.membership_id # A list to look up members by thier email
-
-        print(" - %s AMBA members extracted from file %s."  % (len(self._members), self._members_file))
+    def _parse_entry(self, entry):
+        """ AMBAMember for one entry with only the EAGER fields decoded
+        """
+        (member_id, decode_id), (email, decode_email), (first_name, decode_first), (last_name, decode_last) = self._eager
+        am = AMBAMember.__new__(AMBAMember)
+        am._raw = self._project(entry)
+        am._decoders = self._decoders
+        am.membership_id = decode_id(entry[member_id])
+        am.email = decode_email(entry[email])
+        am.first_name = decode_first(entry[first_name])
+        am.last_name = decode_last(entry[last_name])
+        return am
 
 class AMBAMember(object):
-    def __init__(self):
-        self._first_name       = None
-        self._last_name        = None
-        self._street           = None
-        self._city             = None
-        self._state            = None
-        self._postal_code      = None
-        self._phone            = None
-        self._email            = None
-        self._membership_id    = None
-        self._member_bundle_id = None # Used to link group members
-        self._contrib_date     = None
-        self._contrib_amount   = None
-    
+    """ One member, stored in slots rather than an instance __dict__ so
+        millions of them stay small and attribute access stays cheap
+    """
+    __slots__ = (
+        "first_name",
+        "last_name",
+        "street",
+        "city",
+        "state",
+        "postal_code",
+        "phone",
+        "email",
+        "membership_id",
+        "member_bundle_id", # Used to link group members
+        "contrib_date",
+        "contrib_amount",
+        "_raw",      # Raw values of the fields decoded on first use
+        "_decoders", # { <field>: (<index>, <decoder>), ... } Shared by the members of a file
+    )
+
+    def __init__(self, first_name=None, last_name=None, street=None, city=None, state=None,
+                 postal_code=None, phone=None, email=None, membership_id=None,
+                 member_bundle_id=None, contrib_date=None, contrib_amount=None):
+        self.first_name       = first_name
+        self.last_name        = last_name
+        self.street           = street
+        self.city             = city
+        self.state            = state
+        self.postal_code      = postal_code
+        self.phone            = phone
+        self.email            = email
+        self.membership_id    = membership_id
+        self.member_bundle_id = member_bundle_id
+        self.contrib_date     = contrib_date
+        self.contrib_amount   = contrib_amount
+
+    @classmethod
+    def fields(cls):
+        """ Every field name, parent class fields first, which is also the
+            order of the positional __init__ arguments
+        """
+        return [name for klass in reversed(cls.__mro__) for name in getattr(klass, "__slots__", ()) \
+                    if not name.startswith("_")]
+
+    def __getattr__(self, name):
+        """ Only called for fields that aren't set yet, which are decoded
+            from the raw entry and kept
+        """
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            index, decode = self._decoders[name]
+        except (AttributeError, KeyError):
+            raise AttributeError(name) from None
+        value = decode(self._raw[index] if index is not None else "")
+        setattr(self, name, value)
+        return value
+
     def __str__(self):
         mstr = str()
         mstr += "\tAMBAMember:\n"
-        mstr += "\t - Name:%s %s\n" % (self._first_name, self._last_name)
-        mstr += "\t - Address:%s, %s, %s, %s\n" % (self._street, self._city, self._state, self._postal_code)
-        mstr += "\t - Phone:%s\n" % self._phone
-        mstr += "\t - Email:%s\n" % self._email
-        mstr += "\t - Membership id:%s\n" % self._membership_id
-        mstr += "\t - Bundle id:%s\n" % self._member_bundle_id
-        mstr += "\t - Contribution:%s %s\n" % (self._contrib_date, self._contrib_amount)
+        mstr += self._str_fields()
         return mstr
 
-    @property
-    def first_name(self):
-        return self._first_name
-    @first_name.setter
-    def first_name(self, value):
-        self._first_name = value
-
-    @property
-    def last_name(self):
-        return self._last_name
-    @last_name.setter
-    def last_name(self, value):
-        self._last_name = value
-
-    @property
-    def street(self):
-        return self._street
-    @street.setter
-    def street(self, value):
-        self._street = value
-
-    @property
-    def city(self):
-        return self._city
-    @city.setter
-    def city(self, value):
-        self._city = value
-    
-    @property
-    def state(self):
-        return self._state
-    @state.setter
-    def state(self, value):
-        self._state = value
-
-    @property
-    def postal_code(self):
-        return self._postal_code
-    @postal_code.setter
-    def postal_code(self, value):
-        self._postal_code = value
-
-    @property
-    def phone(self):
-        return self._phone
-    @phone.setter
-    def phone(self, value):
-        self._phone = value
-
-    @property
-    def email(self):
-        return self._email
-    @email.setter
-    def email(self, value):
-        self._email = value
-    
-    @property
-    def membership_id(self):
-        return self._membership_id
-    @membership_id.setter
-    def membership_id(self, value):
-        self._membership_id = value
-
-    @property
-    def member_bundle_id(self):
-        return self._member_bundle_id
-    @member_bundle_id.setter
-    def member_bundle_id(self, value):
-        self._member_bundle_id = value
-
-    @property
-    def contrib_date(self):
-        return self._contrib_date
-    @contrib_date.setter
-    def contrib_date(self, value):
-        self._contrib_date = value
-
-    @property
-    def contrib_amount(self):
-        return self._contrib_amount
-    @contrib_amount.setter
-    def contrib_amount(self, value):
-        self._contrib_amount = value
+    def _str_fields(self):
+        mstr = str()
+        mstr += "\t - Name:%s %s\n" % (self.first_name, self.last_name)
+        mstr += "\t - Address:%s, %s, %s, %s\n" % (self.street, self.city, self.state, self.postal_code)
+        mstr += "\t - Phone:%s\n" % self.phone
+        mstr += "\t - Email:%s\n" % self.email
+        mstr += "\t - Membership id:%s\n" % self.membership_id
+        mstr += "\t - Bundle id:%s\n" % self.member_bundle_id
+        mstr += "\t - Contribution:%s %s\n" % (self.contrib_date, self.contrib_amount)
+        return mstr
 
 
 ################## IMBA MEMBERS ###############################################
 class IMBAMembers(Members): # Inherite frrom Members
-    def __init__(self, members_file):
-        self._members_file = members_file
-        self._members      = dict() # { <member_id>: IMBAMember, ...}
-        self._fields       = dict() # { <field>: <index>, ... }
-        self._emails       = dict() # { <email>: <member_id>, ...}
+    # Fields we expect to be in the IMBA members file
+    REQUIRED_FIELDS = [
+        'Contact ID', \
+        'First Name', \
+        'Last Name', \
+        'Street Address', \
+        'City', \
+        'State', \
+        'Postal Code', \
+        'Email', \
+        'Phone', \
+        'Membership ID', \
+        'Membership Type', \
+        'Membership Term', \
+        'Auto-renew', \
+        'Original Start Date (Since)', \
+        'Current Start Date', \
+        'End Date', \
+        'Latest Contribution Date', \
+        'Latest Contribution Amount', \
+        'Membership Status', \
+        'Parent Membership ID', \
+    ]
+
+    FIELDS = {
+        "first_name":       ("First Name", decode_capitalized),
+        "last_name":        ("Last Name", decode_capitalized),
+        "street":           ("Street Address", decode_text),
+        "city":             ("City", decode_capitalized),
+        "state":            ("State", decode_upper),
+        "postal_code":      ("Postal Code", decode_text),
+        "email":            ("Email", decode_lower),
+        "phone":            ("Phone", decode_text),
+        "membership_id":    ("Membership ID", decode_text),
+        "member_bundle_id": ("Parent Membership ID", decode_text),
+        "member_type":      ("Membership Type", decode_lower),
+        "member_term":      ("Membership Term", decode_lower),
+        "auto_renew":       ("Auto-renew", decode_lower),
+        "orig_start":       ("Original Start Date (Since)", decode_text),
+        "curr_start":       ("Current Start Date", decode_text),
+        "end_date":         ("End Date", decode_text),
+        "contrib_date":     ("Latest Contribution Date", decode_text),
+        "contrib_amount":   ("Latest Contribution Amount", decode_text),
+    }
+    EAGER = Members.EAGER + ("member_term", "auto_renew") # Also needed to sort members by renewal
+
+    def __init__(self, members_file, hashes=False, workers=1, pool=None, cache=None):
+        super().__init__(members_file, hashes=hashes, workers=workers, pool=pool, cache=cache)
         self._members_ay   = dict() # { <member_id>: IMBAMember, ... } Auto-renew yearly members
         self._members_am   = dict() # { <member_id>: IMBAMember, ... } Auto-renew montthly members
         self._members_reg  = dict() # { <member_id>: IMBAMember, ... } Regular members (e.g. no auto-renew)
 
-        # Fields we expect to be in the IMBA members file
-        self._required_fields = [
-            'Contact ID', \
-            'First Name', \
-            'Last Name', \
-            'Street Address', \
-            'City', \
-            'State', \
-            'Postal Code', \
-            'Email', \
-            'Phone', \
-            'Membership ID', \
-            'Membership Type', \
-            'Membership Term', \
-            'Auto-renew', \
-            'Original Start Date (Since)', \
-            'Current Start Date', \
-            'End Date', \
-            'Latest Contribution Date', \
-            'Latest Contribution Amount', \
-            'Membership Status', \
-            'Parent Membership ID', \
-        ]
-
         # Parse and populate
         self._parse_members_file() 
 
@@ -276,131 +1205,677 @@ class IMBAMembers(Members): # Inherite frrom Members
     def members_am(self): # Auto-renew monthly members
         return self._members_am         
 
+    @timed
     def _parse_members_file(self):
         """  - Parse a AMBA member file
              - Create and populate AMBAMember objects
              - Add IMBAMember objects to IMBAMembers.members
              - Add each member email to IMBAMembers.emails
         """
-        print(" Importing IMBA members from %s." % self._members_file)
-        with open(self._members_file, newline='') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',')
+        log.info(" Importing IMBA members from %s." % self._members_file)
+        self._parse_entries()
 
-            # Extract each entry and map it's fields to a member object
-            for entry in reader:  
-                if reader.line_num == 1: # First line is used to map fields
-                    self._map_fields(entry)
-                    continue # Skip to next entry after the fields are mapped
+        log.info(" - %s IMBA members extracted from file %s." % (len(self._members), self._members_file))
+        log.info("   + %s regular members." % (len(self._members_reg)))
+        log.info("   + %s auto-renew yearly members." % (len(self._members_ay)))
+        log.info("   + %s auto-renew monthly members." % (len(self._members_am)))
+        metrics.count("rows", len(self._members))
 
-                im = IMBAMember()
-                im.first_name = entry[self._fields["First Name"]].strip().capitalize()
-                im.last_name = entry[self._fields["Last Name"]].strip().capitalize()
-
-                im.street = entry[self._fields["Street Address"]].strip()
-                im.city = entry[self._fields["City"]].strip().capitalize()
-                im.state = entry[self._fields["State"]].strip().upper()
-                im.postal_code = entry[self._fields["Postal Code"]].strip()
-
-                im.email = entry[self._fields["Email"]].strip().lower()
-                im.phone = entry[self._fields["Phone"]].strip()
-
-                im.membership_id = entry[self._fields["Membership ID"]].strip()
-                im.member_bundle_id = entry[self._fields["Parent Membership ID"]].strip()
-                
-                im.member_type = entry[self._fields["Membership Type"]].strip().lower()
-                im.member_term = entry[self._fields["Membership Term"]].strip().lower()
-                im.auto_renew = entry[self._fields["Auto-renew"]].strip().lower()
-                
-                im.orig_start = entry[self._fields["Original Start Date (Since)"]].strip()
-                im.curr_start = entry[self._fields["Current Start Date"]].strip()
-                im.end_date = entry[self._fields["End Date"]].strip()
-                
-                im.contrib_date = entry[self._fields["Latest Contribution Date"]].strip()
-                im.contrib_amount = entry[self._fields["Latest Contribution Amount"]].strip()
-
-                if im.auto_renew == "yes": # Separate auto-renew members
-                    if im.member_term == "month":
-                        self._members_am[im.membership_id] = im
-
-                    elif im.member_term == "year":
-                        self._members_ay[im.membership_id] = im
-
-                    else:
-                        print("!!!ERROR Membership term is not month/year but is -> %s !!!" % im.member_term)
-                        sys.exit()
-
-                elif im.auto_renew == "no": # Regular members (e.g. no auto-renew)
-                    self._members_reg[im.membership_id] = im
+    @staticmethod
+    def member_class():
+        return IMBAMember
 
-                else:
-                    print("!!!ERROR Auto-renew term is not yes/no but is -> %s !!!" % im.auto_renew)
-                    sys.exit()
+    def _parse_entry(self, entry):
+        """ IMBAMember for one entry with only the EAGER fields decoded
+        """
+        ((member_id, decode_id), (email, decode_email), (first_name, decode_first), (last_name, decode_last),
+         (member_term, decode_term), (auto_renew, decode_renew)) = self._eager
+        im = IMBAMember.__new__(IMBAMember)
+        im._raw = self._project(entry)
+        im._decoders = self._decoders
+        im.membership_id = decode_id(entry[member_id])
+        im.email = decode_email(entry[email])
+        im.first_name = decode_first(entry[first_name])
+        im.last_name = decode_last(entry[last_name])
+        im.member_term = decode_term(entry[member_term])
+        im.auto_renew = decode_renew(entry[auto_renew])
+        return im
+
+    def _check(self, entry):
+        """ Also Auto-renew must be yes/no, and the Membership Term of
+            auto-renew members month/year
+        """
+        reason = super()._check(entry)
+        if reason is not None:
+            return reason
+        (member_term, decode_term), (auto_renew, decode_renew) = self._eager[4:]
+        auto_renew = decode_renew(entry[auto_renew])
+        if auto_renew == "yes":
+            member_term = decode_term(entry[member_term])
+            if member_term not in ("month", "year"):
+                return "Membership term is not month/year but is -> %s" % member_term
+        elif auto_renew != "no":
+            return "Auto-renew term is not yes/no but is -> %s" % auto_renew
+        return None
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot["renewals"] = [_pack(self._members_reg), _pack(self._members_ay), _pack(self._members_am)]
+        return snapshot
+
+    def restore(self, snapshot):
+        super().restore(snapshot)
+        for ids, members in zip(snapshot["renewals"], (self._members_reg, self._members_ay, self._members_am)):
+            ids = _unpack(ids)
+            members.update(zip(ids, map(self._members.__getitem__, ids)))
+
+    @staticmethod
+    def renewal(im):
+        """ "month" or "year" for auto-renew members, None for regular
+            members (e.g. no auto-renew)
+        """
+        if im.auto_renew == "yes": # Separate auto-renew members
+            if im.member_term in ("month", "year"):
+                return im.member_term
+            raise ValueError("Membership term is not month/year but is -> %s" % im.member_term)
 
-                self._members[im.membership_id] = im # All members added to this list
-                self._emails[im.email] = im.membership_id # A list to lookup memmbers by their email
-    
-        print(" - %s IMBA members extracted from file %s." % (len(self._members), self._members_file))
-        print("   + %s regular members." % (len(self._members_reg)))
-        print("   + %s auto-renew yearly members." % (len(self._members_ay)))
-        print("   + %s auto-renew monthly members." % (len(self._members_am)))
+        elif im.auto_renew == "no": # Regular members (e.g. no auto-renew)
+            return None
+
+        # _check quarantines these rows, so getting here is a bug
+        raise ValueError("Auto-renew term is not yes/no but is -> %s" % im.auto_renew)
+
+    def _add_member(self, im, keys, row_hash):
+        renewal = self.renewal(im)
+        if renewal == "month":
+            self._members_am[im.membership_id] = im
+        elif renewal == "year":
+            self._members_ay[im.membership_id] = im
+        else:
+            self._members_reg[im.membership_id] = im
+
+        super()._add_member(im, keys, row_hash) # All members added to this list
 
 class IMBAMember(AMBAMember): # Inherit from AMBAMember
-    def __init__(self):
-        # Fields that don't exist in AMBAMember class
-        self._member_term = None
-        self._auto_renew  = None
-        self._orig_start  = None
-        self._curr_start  = None
-        self._end_date    = None
+    # Fields that don't exist in AMBAMember class
+    __slots__ = (
+        "member_type",
+        "member_term",
+        "auto_renew",
+        "orig_start",
+        "curr_start",
+        "end_date",
+    )
+
+    def __init__(self, first_name=None, last_name=None, street=None, city=None, state=None,
+                 postal_code=None, phone=None, email=None, membership_id=None,
+                 member_bundle_id=None, contrib_date=None, contrib_amount=None,
+                 member_type=None, member_term=None, auto_renew=None,
+                 orig_start=None, curr_start=None, end_date=None):
+        super().__init__(first_name, last_name, street, city, state,
+                         postal_code, phone, email, membership_id,
+                         member_bundle_id, contrib_date, contrib_amount)
+        self.member_type = member_type
+        self.member_term = member_term
+        self.auto_renew  = auto_renew
+        self.orig_start  = orig_start
+        self.curr_start  = curr_start
+        self.end_date    = end_date
 
     def __str__(self):
         mstr = str()
         mstr += "\tIMBAMember:\n"
-        mstr += "\t - Name:%s %s\n" % (self._first_name, self._last_name)
-        mstr += "\t - Address:%s, %s, %s, %s\n" % (self._street, self._city, self._state, self._postal_code)
-        mstr += "\t - Phone:%s\n" % self._phone
-        mstr += "\t - Email:%s\n" % self._email
-        mstr += "\t - Membership id:%s\n" % self._membership_id
-        mstr += "\t - Bundle id:%s\n" % self._member_bundle_id
-        mstr += "\t - Contribution:%s %s\n" % (self._contrib_date, self._contrib_amount)
-        mstr += "\t - Auto-renew/term: %s / %s\n" % (self._auto_renew, self._member_term)
-        mstr += "\t - Orig/current/end date: %s / %s / %s\n" % (self._orig_start, self._curr_start, self._end_date)
+        mstr += self._str_fields()
+        mstr += "\t - Auto-renew/term: %s / %s\n" % (self.auto_renew, self.member_term)
+        mstr += "\t - Orig/current/end date: %s / %s / %s\n" % (self.orig_start, self.curr_start, self.end_date)
         return mstr
 
+
+################## FUZZY MATCHING #############################################
+_SOUNDEX = str.maketrans("bfpvcgjkqsxzdtlmnr", "111122222222334556")
+
+def soundex(value):
+    """ American Soundex code of a name, e.g. Smith/Smyth -> S530
+    """
+    letters = [c for c in normalize_text(value) if "a" <= c <= "z"]
+    if not letters:
+        return ""
+
+    code = letters[0].upper()
+    last = letters[0].translate(_SOUNDEX)
+    for letter in letters[1:]:
+        digit = letter.translate(_SOUNDEX)
+        if digit.isdigit():
+            if digit != last:
+                code += digit
+                if len(code) == 4:
+                    break
+            last = digit
+        elif letter not in "hw": # Vowels separate repeated codes, h and w don't
+            last = ""
+    return code.ljust(4, "0")
+
+
+class FuzzyMatcher(object):
+    """ Find IMBA members that are probably AMBA members even though no
+        key matches exactly (typos, nicknames, swapped first/last names).
+
+        AMBA members are grouped into blocks that share a cheap key:
+          - Soundex of the first or the last name within a postal code
+          - Phone digits
+        An IMBA member is only scored against the AMBA members in its own
+        blocks, so the work grows with the block sizes rather than with
+        AMBA x IMBA. Blocks larger than max_block are too common to say
+        anything and are dropped.
+
+        A similar name alone is never enough, every block also holds a
+        field that isn't the name, so a match shares a postal code or a
+        phone too. Emails aren't blocked on: the local part is mostly the
+        name again, pieces of it matched people who only had similar names.
+    """
+    def __init__(self, members, threshold=0.85, max_block=100):
+        self._threshold   = threshold
+        self._max_block   = max_block
+        self._names       = dict() # { <member_id>: <normalized name>, ... }
+        self._blocks      = dict() # { <block key>: [<member_id>, ...], ... }
+        self._comparisons = 0      # Candidate pairs scored
+        self._oversized   = 0      # Blocks dropped for being larger than max_block
+
+        for member_id, member in members.items():
+            self._names[member_id] = normalize_name(member.first_name, member.last_name)
+            for key in self.block_keys(member):
+                self._blocks.setdefault(key, list()).append(member_id)
+
+        for key in [key for key, ids in self._blocks.items() if len(ids) > max_block]:
+            del self._blocks[key]
+            self._oversized += 1
+
     @property
-    def member_term(self):
-        return self._member_term
-    @member_term.setter
-    def member_term(self, value):
-        self._member_term = value
-    
+    def comparisons(self):
+        return self._comparisons
+
     @property
-    def auto_renew(self):
-        return self._auto_renew
-    @auto_renew.setter
-    def auto_renew(self, value):
-        self._auto_renew = value
+    def oversized(self):
+        return self._oversized
+
+    @classmethod
+    def block_keys(cls, member):
+        keys = set()
+        if member.postal_code:
+            for code in (soundex(member.first_name), soundex(member.last_name)):
+                if code:
+                    keys.add(("postal", member.postal_code[:5], code))
+
+        digits = "".join(c for c in member.phone if c.isdigit())[-10:]
+        if len(digits) >= 7:
+            keys.add(("phone", digits))
+        return keys
+
+    def match(self, member):
+        """ Return (score, member_id) of the best scoring AMBA member at or
+            above the threshold, None if there isn't one
+
+            Score is the similarity 0..1 of the normalized names, also
+            trying the IMBA name with its parts swapped. The IMBA name is
+            set as the second sequence so difflib only indexes it once.
+        """
+        name = normalize_name(member.first_name, member.last_name)
+        if not name:
+            return None
+
+        candidates = set()
+        for key in self.block_keys(member):
+            candidates.update(self._blocks.get(key, ()))
+
+        swapped = " ".join(reversed(name.split()))
+        matchers = [difflib.SequenceMatcher(None, b=name)]
+        if swapped != name:
+            matchers.append(difflib.SequenceMatcher(None, b=swapped))
+
+        best = None
+        for member_id in sorted(candidates):
+            self._comparisons += 1
+            floor = self._threshold if best is None else max(self._threshold, best[0])
+            for sm in matchers:
+                sm.set_seq1(self._names[member_id])
+                if sm.real_quick_ratio() >= floor and sm.quick_ratio() >= floor:
+                    score = sm.ratio()
+                    if score >= floor and (best is None or score > best[0]):
+                        best = (score, member_id)
+                        floor = score
+        return best
+
+
+PARTITION_KEYS = { # Geographic keys fuzzy matching can be split by
+    "state":       operator.attrgetter("state"),
+    "postal_code": lambda member: member.postal_code[:5],
+    "zip3":        lambda member: member.postal_code[:3],
+}
+
+_partitions = None # Tables forked fuzzy matching workers inherit, see PartitionedFuzzy
+
+class PartitionedFuzzy(object):
+    """ Fuzzy matching split by a geographic key so the partitions can be
+        matched on a process pool
+        - An IMBA member is only scored against the AMBA members with the
+          same key (e.g. the same state), each partition gets its own
+          FuzzyMatcher
+        - Workers are forked once the members are in memory and read them
+          from the tables they inherit, a task is only a partition key
+        - Results are keyed by IMBA id, so they don't depend on the number
+          of workers or the order partitions finish in
+    """
+    def __init__(self, amba_members, key="state", threshold=0.85, workers=1):
+        self._amba        = amba_members # { <member_id>: AMBAMember, ... }
+        self._key         = PARTITION_KEYS[key]
+        self._threshold   = threshold
+        self._workers     = workers
+        self._comparisons = 0
+        self._oversized   = 0
+
+        self._amba_ids = dict() # { <partition key>: [<member_id>, ...], ... }
+        for member_id, member in amba_members.items():
+            self._amba_ids.setdefault(self._key(member), list()).append(member_id)
 
     @property
-    def orig_start(self):
-        return self._orig_start
-    @orig_start.setter
-    def orig_start(self, value):
-        self._orig_start = value
+    def comparisons(self):
+        return self._comparisons
 
     @property
-    def curr_start(self):
-        return self._curr_start
-    @curr_start.setter
-    def curr_start(self, value):
-        self._curr_start = value
-    
+    def oversized(self):
+        return self._oversized
+
+    def match_all(self, members, member_ids):
+        """ { <member_id>: (score, amba_id), ... } best AMBA match of each
+            of member_ids in members that has one
+        """
+        global _partitions
+        imba_ids = dict() # { <partition key>: [<member_id>, ...], ... }
+        for member_id in member_ids:
+            imba_ids.setdefault(self._key(members[member_id]), list()).append(member_id)
+
+        # Largest partitions first so a big state doesn't finish last
+        tasks = sorted((key for key in imba_ids if key in self._amba_ids),
+                       key=lambda key: (-len(self._amba_ids[key]) * len(imba_ids[key]), key))
+        _partitions = (self._amba, members, self._amba_ids, imba_ids, self._threshold)
+        try:
+            if self._workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("fork")
+                with concurrent.futures.ProcessPoolExecutor(self._workers, mp_context=context) as pool:
+                    results = list(pool.map(_match_partition, tasks,
+                                            chunksize=max(1, len(tasks) // (self._workers * 8))))
+            else: # One process, or no fork to share the tables
+                results = [_match_partition(key) for key in tasks]
+        finally:
+            _partitions = None
+
+        found = dict()
+        for matches, comparisons, oversized in results:
+            found.update(matches)
+            self._comparisons += comparisons
+            self._oversized += oversized
+        return found
+
+def _match_partition(key):
+    """ Fuzzy match one partition from the inherited tables
+    """
+    amba, imba, amba_ids, imba_ids, threshold = _partitions
+    matcher = FuzzyMatcher(dict((member_id, amba[member_id]) for member_id in amba_ids[key]), threshold=threshold)
+    matches = dict()
+    for member_id in imba_ids[key]:
+        match = matcher.match(imba[member_id])
+        if match is not None:
+            matches[member_id] = match
+    return matches, matcher.comparisons, matcher.oversized
+
+
+################## BUNDLES ####################################################
+class Bundles(object):
+    """ Members linked into households or clubs by their Parent Membership
+        ID, across both exports
+
+        Union-find over membership ids: every member with a parent joins
+        the parent's bundle, union by size and path halving keep each
+        lookup close to constant, so building the bundles is near linear
+        in the number of links. Members without a parent ("0" or blank)
+        and not anyone's parent aren't stored, each is its own bundle.
+    """
+    def __init__(self, *members):
+        self._parent = dict() # { <member_id>: <parent member_id in the tree>, ... }
+        self._size   = dict() # { <root member_id>: <members in the bundle>, ... }
+        for group in members:
+            for member_id, member in group.items():
+                bundle_id = member.member_bundle_id
+                if bundle_id and bundle_id != "0" and bundle_id != member_id:
+                    self.union(member_id, bundle_id)
+
+    def __len__(self): # Bundles with more than one member
+        return len(self._size)
+
     @property
-    def end_date(self):
-        return self._end_date
-    @end_date.setter
-    def end_date(self, value):
-        self._end_date = value
+    def largest(self):
+        return max(self._size.values(), default=1)
+
+    def find(self, member_id):
+        """ Root member id of member_id's bundle
+        """
+        parent = self._parent
+        while member_id in parent:
+            grandparent = parent.get(parent[member_id])
+            if grandparent is not None:
+                parent[member_id] = grandparent # Path halving
+            member_id = parent[member_id]
+        return member_id
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        size_a, size_b = self._size.get(a, 1), self._size.get(b, 1)
+        if size_a < size_b:
+            a, b = b, a
+        self._parent[b] = a
+        self._size[a] = size_a + size_b
+        self._size.pop(b, None)
+        return a
+
+    def group(self, members):
+        """ members reordered so each bundle is together, bundles in the
+            order of their first member
+        """
+        groups = dict() # { <root member_id>: [member, ...], ... }
+        for member in members:
+            groups.setdefault(self.find(member.membership_id), list()).append(member)
+        return [member for group in groups.values() for member in group]
+
+
+################## EXPORT #####################################################
+SHARD_KEYS = dict(PARTITION_KEYS, term=lambda member: IMBAMembers.renewal(member) or "regular") # Keys to shard exports by
+
+class ExportShard(object):
+    """ One output file being written by an ExportFiles writer thread
+    """
+    def __init__(self, temp, path, key, fd, header):
+        self.temp   = temp # Written here, renamed to path once complete
+        self.path   = path
+        self.key    = key
+        self.fd     = fd
+        self.writer = csv.writer(fd, lineterminator="\n")
+        self.writer.writerow(header)
+        self.rows   = 0
+        self.bytes  = 0    # CSV text written so far, before compression
+        self.sha256 = None
+
+class ExportFiles(object):
+    """ CSV output files written together in one pass
+        - Each file starts with the same header
+        - Files are compressed when compress is gz, bz2 or xz
+        - Rows are handed to the files in batches, each file is written by
+          its own thread of a pool, so formatting, compressing and disk
+          writes for the files overlap
+        - With max_rows or max_bytes each file is split as it is written
+          into shards of at most that many rows or bytes of CSV (before
+          compression), each with the header: <name>_0001.csv,
+          <name>_0002.csv... With keyed, rows are also split by the key
+          given to write(): <name>_<key>_0001.csv...
+        - Files are written to temporary names, fsynced and renamed into
+          place only once all of them are complete, then a manifest with
+          the row count, size and sha256 of each file is written last
+        - Use as a context manager so the files are always closed, an
+          error leaves the final paths as they were
+    """
+    BUFFER_SIZE = 1 << 20
+    BATCH_ROWS  = 2048 # Rows handed to a writer thread at a time
+
+    def __init__(self, directory, names, header, compress=None, manifest="manifest.json",
+                 max_rows=None, max_bytes=None, keyed=False):
+        self._dir       = directory
+        self._names     = list(names)
+        self._header    = header
+        self._compress  = compress
+        self._max_rows  = max_rows
+        self._max_bytes = max_bytes
+        self._keyed     = keyed
+        self._sharded   = bool(max_rows or max_bytes or keyed)
+        self._batches   = dict() # { <name>: [<row> or (<row>, <key>), ...], ... } Rows not handed to the writer yet
+        self._queues    = dict() # { <name>: queue.Queue of row batches, None ends the file }
+        self._shards    = dict() # { <name>: [ExportShard, ...], ... } In the order they were started
+        self._labels    = dict() # { <name>: { <key>: <label in the file names>, ... }, ... }
+        self._manifest  = os.path.join(directory, manifest)
+        self._closed    = False
+
+        # A manifest from before doesn't describe the files about to be replaced
+        if os.path.exists(self._manifest):
+            os.remove(self._manifest)
+
+        self._pool    = concurrent.futures.ThreadPoolExecutor(len(self._names), thread_name_prefix="itoa-export")
+        self._futures = dict() # { <name>: Future of its writer thread, ... }
+        for name in self._names:
+            self._batches[name] = list()
+            self._queues[name] = queue.Queue(4)
+            self._shards[name] = list()
+            self._labels[name] = dict()
+            if not self._sharded: # The one file is there even without rows
+                self._open_shard(name, None, None)
+            self._futures[name] = self._pool.submit(self._write_file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    @property
+    def paths(self): # Every file written, once closed
+        return [shard.path for name in self._names for shard in self._shards[name]]
+
+    def write(self, row, names, key=None):
+        """ Write row to each of the named files, key picks the shard when
+            keyed
+        """
+        item = (row, key) if self._sharded else row
+        for name in names:
+            batch = self._batches[name]
+            batch.append(item)
+            if len(batch) == self.BATCH_ROWS:
+                self._put(name, batch)
+                self._batches[name] = list()
+
+    def _put(self, name, item):
+        """ Hand item to the writer of name, its error is raised here if it
+            stopped, rather than waiting on a queue nobody drains
+        """
+        future = self._futures[name]
+        while True:
+            try:
+                self._queues[name].put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if future.done():
+                    raise future.exception() or RuntimeError("Writer of %s stopped" % name)
+
+    def _open_shard(self, name, key, number):
+        """ Start a file: <name> or, sharded, <name>[_<key>]_<number>
+        """
+        base, extension = os.path.splitext(name)
+        if number is not None:
+            if self._keyed:
+                base += "_" + self._label(name, key)
+            base += "_%04d" % number
+        path = os.path.join(self._dir, base + extension) + ("." + self._compress if self._compress else "")
+        temp = os.path.join(self._dir, ".%s.tmp" % os.path.basename(path))
+        shard = ExportShard(temp, path, key, open_output(temp, self._compress, buffering=self.BUFFER_SIZE),
+                            self._header)
+        self._shards[name].append(shard)
+        return shard
+
+    def _label(self, name, key):
+        """ Key as it goes in file names, keys that clean up the same
+            (80 301 and 80-301) get a numbered label each
+        """
+        labels = self._labels[name]
+        if key not in labels:
+            clean = re.sub(r"[^0-9A-Za-z]+", "-", key or "").strip("-") or "blank"
+            label, count = clean, 1
+            taken = set(labels.values())
+            while label in taken:
+                count += 1
+                label = "%s-%s" % (clean, count)
+            labels[key] = label
+        return labels[key]
+
+    def _write_file(self, name):
+        """ Writer thread of one file: each batch until None, then every
+            shard is flushed to disk and its sha256 taken
+        """
+        shards = self._shards[name]
+        try:
+            if self._sharded:
+                self._write_shards(name, iter(self._queues[name].get, None))
+            else:
+                for batch in iter(self._queues[name].get, None):
+                    shards[0].writer.writerows(batch)
+                    shards[0].rows += len(batch)
+        finally:
+            for shard in shards:
+                shard.fd.close()
+        for shard in shards:
+            shard.sha256 = fsync_digest(shard.temp)
+
+    def _write_shards(self, name, batches):
+        """ Rows into the open shard of their key, a new shard is started
+            when the next row would go over max_rows or max_bytes
+        """
+        line = io.StringIO()
+        formatter = csv.writer(line, lineterminator="\n")
+        def encode(row):
+            line.seek(0)
+            line.truncate()
+            formatter.writerow(row)
+            return line.getvalue()
+        header = len(encode(self._header).encode("utf-8"))
+
+        current = dict() # { <key>: ExportShard being written, ... }
+        numbers = dict() # { <key>: <shards started>, ... }
+        for batch in batches:
+            for row, key in batch:
+                key = key if self._keyed else None
+                shard = current.get(key)
+                if self._max_bytes:
+                    text = encode(row)
+                    size = len(text.encode("utf-8"))
+                if shard is not None and ((self._max_rows and shard.rows >= self._max_rows) or
+                        (self._max_bytes and shard.rows and shard.bytes + size > self._max_bytes)):
+                    shard.fd.close()
+                    shard = None
+                if shard is None:
+                    numbers[key] = numbers.get(key, 0) + 1
+                    shard = current[key] = self._open_shard(name, key, numbers[key])
+                    shard.bytes = header
+                if self._max_bytes:
+                    shard.fd.write(text)
+                    shard.bytes += size
+                else:
+                    shard.writer.writerow(row)
+                shard.rows += 1
+
+    def close(self):
+        """ Finish every file, move them into place, then write the manifest
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            for name in self._names:
+                self._put(name, self._batches[name])
+                self._put(name, None)
+            for future in self._futures.values():
+                future.result()
+        except BaseException:
+            self._abort() # The other writers may still be waiting for rows
+            raise
+        self._pool.shutdown()
+
+        for shard in self._all_shards():
+            os.replace(shard.temp, shard.path)
+        fsync_directory(self._dir)
+
+        manifest = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "files": dict()}
+        for name in self._names:
+            for shard in self._shards[name]:
+                entry = {"rows": shard.rows, "bytes": os.path.getsize(shard.path), "sha256": shard.sha256}
+                if self._sharded:
+                    entry["export"] = name
+                    if self._keyed:
+                        entry["key"] = shard.key
+                manifest["files"][os.path.basename(shard.path)] = entry
+        if self._sharded: # What each export was split into, in order
+            manifest["exports"] = dict((name, {
+                "rows": sum(shard.rows for shard in self._shards[name]),
+                "shards": [os.path.basename(shard.path) for shard in self._shards[name]],
+            }) for name in self._names)
+        tmp = self._manifest + ".tmp"
+        with open(tmp, 'w') as fd:
+            json.dump(manifest, fd, indent=2)
+        fsync_digest(tmp)
+        os.replace(tmp, self._manifest)
+        fsync_directory(self._dir)
+
+    def _abort(self):
+        """ Stop the writers and drop the temporary files
+        """
+        self._closed = True
+        for name, future in self._futures.items():
+            while True: # Make room for the end marker if the writer is gone
+                try:
+                    self._queues[name].put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    if future.done():
+                        break
+        for future in self._futures.values():
+            try:
+                future.result()
+            except Exception: # The error being raised matters more
+                pass
+        self._pool.shutdown()
+        self._remove_temps()
+
+    def _all_shards(self):
+        return [shard for name in self._names for shard in self._shards[name]]
+
+    def _remove_temps(self):
+        for shard in self._all_shards():
+            if os.path.exists(shard.temp):
+                os.remove(shard.temp)
+
+def fsync_digest(fname):
+    """ Flush a closed file to disk and return its sha256
+    """
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as fd:
+        for block in iter(lambda: fd.read(1 << 20), b""):
+            sha.update(block)
+        os.fsync(fd.fileno())
+    return sha.hexdigest()
+
+def fsync_directory(directory):
+    """ Make renames in directory durable, where the platform allows it
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
 
 ################## ALL MEMBERS ################################################
 class AllMembers(object):
@@ -408,74 +1883,180 @@ class AllMembers(object):
         - Find duplicates
         - Export file with new members
     """
-
-    def __init__(self, amba_members, imba_members, directory):
-        print(" Analizing both sets of members")
-
-        self._dir  = directory
-        self._amba = amba_members
-        self._imba = imba_members
+    OUTPUT_FILES = ["new_all.csv", "new_reg.csv", "new_auto_year.csv", "new_auto_month.csv"]
+
+    def __init__(self, amba_members, imba_members, directory, fuzzy=None, state=None, compress=None,
+                 households=False, partition=None, workers=1, shard_rows=None, shard_bytes=None, shard_key=None,
+                 expiring=None):
+        log.info(" Analizing both sets of members")
+
+        self._dir   = directory
+        self._amba  = amba_members
+        self._imba  = imba_members
+        self._fuzzy = fuzzy # Fuzzy match threshold, None to only use exact matches
+        self._state = state # IncrementalState from the previous run, None for a full run
+        self._compress = compress # Output file compression, None for plain CSV
+        self._bundles  = None     # Bundles when a household shares its members' duplicate status
+        self._partition = partition # PARTITION_KEYS key to split fuzzy matching by, None for one matcher
+        self._workers   = workers   # Processes to fuzzy match partitions on
+        self._shards    = (shard_rows, shard_bytes, shard_key) # Output file limits and SHARD_KEYS key, None for none
+        self._window    = expiry_window(expiring) # (<first day>, <last day>) renewals to export, None for all
 
         self._dup_ids = set()  # Duplicate member ids
+        self._matches = dict() # { <imba_id>: (<rule>, <amba_id>), ... } Why each duplicate matched
         self._new_reg = list() # New regular memebers to add (e.g. no auto-renew)
         self._new_ay  = list() # New auto-renew yearly members
         self._new_am  = list() # New auto-renew montly members
         self._new_all = list() # All new members
         
         self._duplicate_members()  # Find duplicate members
+        if households:
+            self._household_members() # Whole bundles with an AMBA member are duplicates
         self._unique_members()     # Build dict of unique members
         self._output_new_members() # Output the new members
 
-    def _duplicate_members(self):
-        print(" - Looking for duplicate members, these will not be exported.")
+    @property
+    def matches(self): # { <imba_id>: (<rule>, <amba_id>), ... }
+        return self._matches
 
-        # Find duplicates base on membership id
-        amba_ids = self._amba.members
-        for imba_id in self._imba.members:
-            if imba_id in amba_ids:
-                #print("  + Duplicate member id %s")
-                self._dup_ids.add(imba_id)
+    @property
+    def new_members(self): # All new members, in IMBA file order
+        return self._new_all
 
-        # Find duplicates based on first and last name
-        for imba_id in self._imba.members:
-            fname_imba = self._imba.members[imba_id].first_name.lower()
-            lname_imba = self._imba.members[imba_id].last_name.lower()
-            name_imba = fname_imba + lname_imba
+    def exports(self, member):
+        """ Output files a new member is written to
+        """
+        if member.membership_id in self._imba.members_ay: # Auto-renew yearly members
+            return (self.OUTPUT_FILES[0], self.OUTPUT_FILES[2])
+        elif member.membership_id in self._imba.members_am: # Auto-renew montly members
+            return (self.OUTPUT_FILES[0], self.OUTPUT_FILES[3])
+        else: # Regular members file (e.g not auto-renew)
+            return (self.OUTPUT_FILES[0], self.OUTPUT_FILES[1])
+
+    def _incremental(self):
+        return self._state is not None and self._state.loaded
+
+    @timed
+    def _duplicate_members(self):
+        log.info(" - Looking for duplicate members, these will not be exported.")
+
+        # Incremental runs only check the rows that changed, or that an
+        # AMBA change could affect, and keep the last result for the rest
+        check_ids = self._imba.members
+        if self._incremental():
+            check_ids, carried = self._state.delta(self._amba, self._imba, self._fuzzy)
+            self._matches.update(carried)
+            self._dup_ids.update(carried)
+            log.info(" - Incremental run: checking %s of %s IMBA members, %s duplicates carried over." \
+                    % (len(check_ids), len(self._imba.members), len(carried)))
+
+        # One pass over the IMBA members, each one is looked up in the
+        # AMBA index by membership id, then email, then full name
+        index = self._amba.index
+        progress = log.progress("Matched")
+        for rows, imba_id in enumerate(check_ids, 1):
+            match = index.match(self._imba.members[imba_id])
+            if match is not None:
+                self._dup_ids.add(imba_id)
+                self._matches[imba_id] = match
+            if not rows & Progress.EVERY:
+                progress.update(rows)
+
+        if self._fuzzy is not None:
+            self._fuzzy_duplicate_members(check_ids)
+
+        log.info(" - %s duplicate members found. "  % len(self._dup_ids))
+        counts = dict((rule, 0) for rule in MemberIndex.RULES + ("fuzzy",))
+        for rule, amba_id in self._matches.values():
+            counts[rule] += 1
+        for rule, count in counts.items():
+            log.info("   + %s matched by %s" % (count, rule))
+        log.info()
+        metrics.count("rows", len(check_ids))
+        metrics.count("duplicates", len(self._dup_ids))
+        metrics.count("duplicates_by_rule", counts)
+
+    def _fuzzy_duplicate_members(self, check_ids):
+        """ Score the IMBA members left over after exact matching against
+            the AMBA members in the same blocks, and the same partition
+            when matching is partitioned
+        """
+        remaining = [imba_id for imba_id in check_ids if imba_id not in self._dup_ids]
+        if self._partition is not None:
+            log.info(" - Fuzzy matching remaining members by %s on %s workers (threshold %s)." \
+                    % (self._partition, self._workers, self._fuzzy))
+            matcher = PartitionedFuzzy(self._amba.members, key=self._partition, threshold=self._fuzzy,
+                                       workers=self._workers)
+            found = matcher.match_all(self._imba.members, remaining)
+        else:
+            log.info(" - Fuzzy matching remaining members (threshold %s)." % self._fuzzy)
+            matcher = FuzzyMatcher(self._amba.members, threshold=self._fuzzy)
+            found = dict()
+            for imba_id in remaining:
+                match = matcher.match(self._imba.members[imba_id])
+                if match is not None:
+                    found[imba_id] = match
+
+        for imba_id in remaining:
+            if imba_id in found:
+                score, amba_id = found[imba_id]
+                self._dup_ids.add(imba_id)
+                self._matches[imba_id] = ("fuzzy", amba_id)
+                member = self._imba.members[imba_id]
+                a = self._amba.members[amba_id]
+                log.detail("   + %s %s ~ %s %s (%.2f)" % (member.first_name, member.last_name, a.first_name, a.last_name, score))
+
+        checked = len(remaining)
+        log.info("   + %s candidate pairs compared for %s members (%.1f per member, %s oversized blocks skipped)" \
+                % (matcher.comparisons, checked, matcher.comparisons / max(checked, 1), matcher.oversized))
+        metrics.count("fuzzy_comparisons", matcher.comparisons)
+
+    @timed
+    def _household_members(self):
+        """ IMBA members in the same bundle as an AMBA member, or as an
+            IMBA duplicate, are duplicates too
+        """
+        log.info(" - Looking for members of households already in AMBA.")
+        bundles = Bundles(self._amba.members, self._imba.members)
 
-            for amba_id in self._amba.members:
-                fname_amba = self._amba.members[amba_id].first_name.lower()
-                lname_amba = self._amba.members[amba_id].last_name.lower()
-                name_amba = fname_amba + lname_amba
+        known = dict() # { <root member_id>: <amba_id>, ... } Bundles with an AMBA member
+        for amba_id in self._amba.members:
+            known.setdefault(bundles.find(amba_id), amba_id)
+        for imba_id, (rule, amba_id) in self._matches.items():
+            known.setdefault(bundles.find(imba_id), amba_id)
 
-                if name_imba == name_amba:
+        found = 0
+        for imba_id in self._imba.members:
+            if imba_id not in self._dup_ids:
+                amba_id = known.get(bundles.find(imba_id))
+                if amba_id is not None:
                     self._dup_ids.add(imba_id)
-                    #print("   + Duplicate name: %s %s" % (self._imba.members[imba_id].first_name, self._imba.members[imba_id].last_name))
-
-        # Find duplicates based on email
-        for email in self._amba.emails: 
-            if email in self._imba.emails:
-                #print("   + Duplicate member email:%s" % email)
-                i = self._imba.members[self._imba.emails[email]]
-                #a = self._amba.members[self._amba.emails[email]]
-                #print(self._imba.members[self._imba.emails[email]])
-                #print(self._amba.members[self._amba.emails[email]])
-                #print("     AMBA info: %s %s %s " % (a.first_name, a.last_name, a.membership_id))
-                #print("     IMBA info: %s %s %s orig:%s cur:%s exp:%s" % (i.first_name, i.last_name, i.membership_id, i.orig_start, i.curr_start, i.end_date))
-                self._dup_ids.add(i.membership_id)
-
-        print(" - %s duplicate members found. "  % len(self._dup_ids))
-        print()
+                    self._matches[imba_id] = ("household", amba_id)
+                    found += 1
 
+        self._bundles = bundles
+        log.info("   + %s bundles, the largest with %s members" % (len(bundles), bundles.largest))
+        log.info("   + %s matched by household" % found)
+        log.info()
+        metrics.count("bundles", len(bundles))
+        metrics.count("household_duplicates", found)
+
+    @timed
     def _unique_members(self):
         """ IMBA members that aren't already AMBA members
         """
-        print(" - New members to add:")
+        log.info(" - New members to add:")
+        not_expiring = 0
         for imba_id in self._imba.members:
             if imba_id not in self._dup_ids: # Already an AMBA member
                 member = self._imba.members[imba_id]
-                
+                if self._window is not None and not self._expiring(member):
+                    not_expiring += 1
+                    continue
+
                 self._new_all.append(member) # All new members
-                print("   + %s %s (%s auto-renew:%s)" % (member.first_name, member.last_name, member.member_term, member.auto_renew))
+                if log.details:
+                    log.detail("   + %s %s (%s auto-renew:%s)" % (member.first_name, member.last_name, member.member_term, member.auto_renew))
 
                 # Auto-rewnew monthly members
                 if member.membership_id in self._imba.members_ay: 
@@ -489,113 +2070,703 @@ class AllMembers(object):
                 elif member.membership_id in self._imba.members_reg: 
                     self._new_reg.append(member)
 
-        print()
-        print(" - %s new membmers to add:" % len(self._new_all))
-        print("   + %s regular members" % len(self._new_reg))
-        print("   + %s auto yearly members" % len(self._new_ay))
-        print("   + %s auto monthly members" % len(self._new_am))
-        print()
+        if self._bundles is not None: # Households are exported together
+            self._new_all = self._bundles.group(self._new_all)
+
+        log.info()
+        if self._window is not None:
+            log.info(" - %s new members left out, not renewing by %s" % (not_expiring, format_date(self._window[1])))
+        log.info(" - %s new membmers to add:" % len(self._new_all))
+        log.info("   + %s regular members" % len(self._new_reg))
+        log.info("   + %s auto yearly members" % len(self._new_ay))
+        log.info("   + %s auto monthly members" % len(self._new_am))
+        log.info()
+        metrics.count("rows", len(self._imba.members))
+        metrics.count("new_members", len(self._new_all))
+
+    def _output_header(self):
+        """ Header for the output files from the AMBA required fields
+        """
+        return AMBAMembers.REQUIRED_FIELDS + ["Renewal due", "Member since"]
 
-    def _get_member_output(self, members):
-        """ Given a list of members build the output string 
+    def _output_row(self, member):
+        """ Fields of one output row, in the order of the header
         """
+        # If membership is renewed each month set the end date
+        # to a year from the start date
+        if member.member_term == "month":
+            renewal = renewal_day(member)
+            renewal = format_date(renewal) if renewal is not None else ""
+        else:
+            renewal = member.end_date
+
+        return [
+            member.membership_id,
+            member.first_name,
+            member.last_name,
+            member.email,
+            member.phone,
+            "Yes", # All exported are IMBA members
+            member.street,
+            member.city,
+            member.state,
+            member.postal_code,
+            member.contrib_date,
+            member.contrib_amount,
+            "" if member.member_bundle_id == "0" else member.member_bundle_id, # Leave blank if 0
+            renewal,
+            member.curr_start,
+        ]
 
-        # Get the header from the required fields
-        output = str()
-        output += ",".join(self._amba.required_fields) 
-        output += ","
-        output += "Renewal due"
-        output += "," 
-        output += "Member since"
-        output += "\n" 
+    @timed
+    def _output_new_members(self):
+        """ Write the results to 4 separate files, all new members and one
+            per membership renewal type, in a single pass over the members
+        """
+        log.info(" - Output new members to files:")
+        self._export_members(self._new_all, "")
+        metrics.count("rows", len(self._new_all))
+
+        # Incremental runs also write the new members that weren't in the
+        # last run's output, or whose row changed since then
+        if self._incremental():
+            delta = [m for m in self._new_all if self._state.changed(m.membership_id, self._imba.hashes)]
+            log.info(" - Output %s new or changed members to delta files:" % len(delta))
+            self._export_members(delta, "delta_")
+            metrics.count("delta_rows", len(delta))
+
+    def _expiring(self, member):
+        """ True if a member renews within the expiry window
+        """
+        day = renewal_day(member)
+        return day is not None and self._window[0] <= day <= self._window[1]
 
-        # Build the members string
-        for member in members:
-            output += member.membership_id    + ","
-            output += member.first_name       + ","
-            output += member.last_name        + ","
-            output += member.email            + ","
-            output += member.phone            + ","
-            output += "Yes"                   + "," # All exported are IMBA members
-            output += member.street           + ","
-            output += member.city             + ","
-            output += member.state            + ","
-            output += member.postal_code      + ","
-            output += member.contrib_date     + ","
-            output += member.contrib_amount   + ","
-
-            if member.member_bundle_id == "0": 
-                output += "," # Leave blank if 0
-            else:
-                output += member.member_bundle_id + ","
-
-            # If membership is renewed each month set the end date
-            # to a year from the start date
-            if member.member_term == "month":
-                month,day,year = member.curr_start.split("/")
-                year = int(year) + 1
-                output += "%s/%s/%s," % (month,day,year)
-            else:
-                output += member.end_date + ","
-            output += member.curr_start + ","
-            output += "\n"
+    def _export_files(self, names, manifest):
+        """ ExportFiles for names, sharded as asked for
+        """
+        shard_rows, shard_bytes, shard_key = self._shards
+        return ExportFiles(self._dir, names, self._output_header(), self._compress, manifest=manifest,
+                           max_rows=shard_rows, max_bytes=shard_bytes, keyed=shard_key is not None)
 
-        return output
+    def _shard_key(self):
+        """ Function of a member giving its shard key, None if not keyed
+        """
+        return SHARD_KEYS.get(self._shards[2])
 
-    def _output_new_members(self):
-        """ Write the results to 3 separate files
-            corresponding to membership renewal type
+    def _export_members(self, members, prefix):
+        """ Write members to the output files, names starting with prefix
         """
-        print(" - Output new members to files:")
+        names = [prefix + name for name in self.OUTPUT_FILES]
+        shard_key = self._shard_key()
+        with self._export_files(names, prefix + "manifest.json") as export:
+            for member in members:
+                export.write(self._output_row(member), [prefix + name for name in self.exports(member)],
+                             shard_key(member) if shard_key else None)
 
-        # All new members
-        output = self._get_member_output(self._new_all)
-        fname = os.path.join(self._dir, "new_all.csv")
-        print("   + %s" % fname)
-        with open(fname, 'w') as fd:
-            fd.write(output)
+        for fname in export.paths:
+            log.info("   + %s" % fname)
 
-        # Regular members file (e.g not auto-renew)
-        output = self._get_member_output(self._new_reg)
-        fname = os.path.join(self._dir, "new_reg.csv")
-        print("   + %s" % fname)
-        with open(fname, 'w') as fd:
-            fd.write(output)
 
-        # Auto-renew yearly members
-        output = self._get_member_output(self._new_ay)
-        fname = os.path.join(self._dir, "new_auto_year.csv")
-        print("   + %s" % fname)
-        with open(fname, 'w') as fd:
-            fd.write(output)
+################## MERGED IMBA EXPORTS #########################################
+def date_key(value):
+    """ Zero padded day number of a date so dates sort as strings, 0000000
+        when the date is missing or not a date
+    """
+    return "%07d" % (parse_date(value) or 0)
+
+
+class IMBAExportMerge(object):
+    """ The latest record of every member across many IMBA exports, with
+        only a bounded number of rows in memory at any time
+        - Each export is read in runs of run_size rows, each run sorted
+          by membership id and written to a file in directory
+        - The runs are k-way merged, at most fan_in at a time, keeping one
+          record per member: the latest current start date, then end
+          date, with ties going to the later export
+        - Iterating yields the merged IMBAMembers in membership id order
+    """
+    KEYS = 5 # Sort key columns in front of the member fields of a run row
+
+    def __init__(self, imba_files, directory, run_size=200000, fan_in=64):
+        self._files    = imba_files
+        self._dir      = directory
+        self._run_size = run_size
+        self._fan_in   = fan_in
+        self._runs     = list() # Run files, each sorted by sort key
+        self._written  = 0      # Run files written, to name the next one
+        self._rows     = 0      # Rows read from the exports, also the row number in the sort key
+        self._fields   = IMBAMember.fields()
+
+        self._sort_runs()
+        while len(self._runs) > self._fan_in:
+            self._merge_pass()
 
-        # Auto-renew montly members
-        output = self._get_member_output(self._new_am)
-        fname = os.path.join(self._dir, "new_auto_month.csv")
-        print("   + %s" % fname)
-        with open(fname, 'w') as fd:
-            fd.write(output)
+    @property
+    def rows(self):
+        return self._rows
+
+    def _sort_key(self, member, file_no, row_no):
+        """ Id, then the dates and position that decide the latest record
+        """
+        return [member.membership_id, date_key(member.curr_start), date_key(member.end_date),
+                "%06d" % file_no, "%012d" % row_no]
+
+    @timed
+    def _sort_runs(self):
+        log.info(" Sorting %s IMBA exports into runs of %s rows." % (len(self._files), self._run_size))
+        for file_no, fname in enumerate(self._files):
+            rows = list()
+            for member in IMBAMembers.stream(fname):
+                rows.append(self._sort_key(member, file_no, self._rows) +
+                            [getattr(member, name) for name in self._fields])
+                self._rows += 1
+                if len(rows) == self._run_size:
+                    rows.sort()
+                    self._write_run(rows)
+                    rows = list()
+            if rows:
+                rows.sort()
+                self._write_run(rows)
+            log.info(" - %s sorted." % fname)
+        log.info(" - %s rows in %s runs." % (self._rows, len(self._runs)))
+        metrics.count("rows", self._rows)
+        metrics.count("runs", len(self._runs))
+
+    def _write_run(self, rows):
+        """ Write rows, already in sort key order, to a new run file
+        """
+        self._written += 1
+        fname = os.path.join(self._dir, "run_%06d.csv" % self._written)
+        with open(fname, 'w', newline='', encoding='utf-8') as fd:
+            csv.writer(fd).writerows(rows)
+        self._runs.append(fname)
+
+    def _read_run(self, fname):
+        with open(fname, newline='', encoding='utf-8') as fd:
+            yield from csv.reader(fd)
+
+    def _merge(self, runs):
+        """ Latest row of each member from sorted runs, in id order
+        """
+        # Rows of one member come together, oldest first, as the sort key
+        # is unique: id, dates, export then row number
+        last = None
+        for row in heapq.merge(*[self._read_run(fname) for fname in runs]):
+            if last is not None and row[0] != last[0]:
+                yield last
+            last = row
+        if last is not None:
+            yield last
+
+    def _merge_pass(self):
+        """ Merge the runs fan_in at a time into fewer, longer runs
+        """
+        runs, self._runs = self._runs, list()
+        log.info(" - Merging %s runs %s at a time." % (len(runs), self._fan_in))
+        for i in range(0, len(runs), self._fan_in):
+            self._write_run(self._merge(runs[i:i + self._fan_in]))
+            for fname in runs[i:i + self._fan_in]:
+                os.remove(fname)
+
+    def __iter__(self):
+        for row in self._merge(self._runs):
+            yield IMBAMember(*row[self.KEYS:])
+
+
+class MergedAllMembers(AllMembers):
+    """ AllMembers for IMBA members streamed one at a time, from an
+        IMBAExportMerge or a single export
+        - Each IMBA member is matched and exported as it is read, only the
+          AMBA members and index are held in memory
+        - Given the matches already found out of core by a
+          PartitionedMatcher, the AMBA members aren't needed at all
+        - New members are counted, not kept
+    """
+    def __init__(self, amba_members, imba_members, directory, fuzzy=None, matches=None, compress=None,
+                 shard_rows=None, shard_bytes=None, shard_key=None, expiring=None):
+        log.info(" Analizing both sets of members")
+
+        self._dir   = directory
+        self._amba  = amba_members
+        self._imba  = imba_members
+        self._fuzzy = fuzzy
+        self._state = None
+        self._compress = compress
+        self._shards = (shard_rows, shard_bytes, shard_key)
+        self._window = expiry_window(expiring)
+
+        self._dup_ids = set()
+        self._matches = matches or dict()
+        self._found   = matches is not None # Matches come from PartitionedMatcher
+        self._new_all = list()
+
+        self._stream_members()
+
+    def exports(self, member):
+        renewal = IMBAMembers.renewal(member)
+        if renewal == "year": # Auto-renew yearly members
+            return (self.OUTPUT_FILES[0], self.OUTPUT_FILES[2])
+        elif renewal == "month": # Auto-renew montly members
+            return (self.OUTPUT_FILES[0], self.OUTPUT_FILES[3])
+        else: # Regular members file (e.g not auto-renew)
+            return (self.OUTPUT_FILES[0], self.OUTPUT_FILES[1])
+
+    @timed
+    def _stream_members(self):
+        """ Match each merged member against the AMBA index and write the
+            new ones to the output files
+        """
+        log.info(" - Matching IMBA members and writing the new ones to files.")
+        matcher = None
+        if self._fuzzy is not None:
+            matcher = FuzzyMatcher(self._amba.members, threshold=self._fuzzy)
+
+        counts = dict((rule, 0) for rule in MemberIndex.RULES + ("fuzzy",))
+        new = dict((name, 0) for name in self.OUTPUT_FILES)
+        rows = 0
+        not_expiring = 0
+        progress = log.progress("Matched and written")
+        shard_key = self._shard_key()
+        with self._export_files(self.OUTPUT_FILES, "manifest.json") as export:
+            for member in self._imba:
+                rows += 1
+                if not rows & Progress.EVERY:
+                    progress.update(rows)
+                if self._found:
+                    match = self._matches.get(member.membership_id)
+                else:
+                    match = self._amba.index.match(member)
+                if match is None and matcher is not None and matcher.match(member) is not None:
+                    match = ("fuzzy", None)
+                if match is not None:
+                    counts[match[0]] += 1
+                    continue
+                if self._window is not None and not self._expiring(member):
+                    not_expiring += 1
+                    continue
+
+                routes = self.exports(member)
+                export.write(self._output_row(member), routes, shard_key(member) if shard_key else None)
+                for name in routes:
+                    new[name] += 1
+
+        log.info(" - %s IMBA members, %s duplicate members found." % (rows, sum(counts.values())))
+        for rule, count in counts.items():
+            log.info("   + %s matched by %s" % (count, rule))
+        if self._window is not None:
+            log.info(" - %s new members left out, not renewing by %s" % (not_expiring, format_date(self._window[1])))
+        log.info(" - %s new membmers to add:" % new[self.OUTPUT_FILES[0]])
+        log.info("   + %s regular members" % new[self.OUTPUT_FILES[1]])
+        log.info("   + %s auto yearly members" % new[self.OUTPUT_FILES[2]])
+        log.info("   + %s auto monthly members" % new[self.OUTPUT_FILES[3]])
+        for fname in export.paths:
+            log.info("   + %s" % fname)
+        log.info()
+        metrics.count("rows", rows)
+        metrics.count("duplicates", sum(counts.values()))
+        metrics.count("duplicates_by_rule", counts)
+        metrics.count("new_members", new[self.OUTPUT_FILES[0]])
+
+
+################## OUT-OF-CORE MATCHING #########################################
+class PartitionedMatcher(object):
+    """ The same matches as AllMembers finds with the AMBA index, without
+        holding either set of members in memory
+        - Both inputs are hash partitioned to spill files in directory by
+          each match key (id, normalized email, normalized name)
+        - Partition pairs are joined one at a time: the AMBA side loaded
+          into a dict, the IMBA side streamed past it
+        - Partitions too big for the memory budget are split again with a
+          different hash, up to MAX_DEPTH times
+
+        As with the index, each IMBA member matches the first AMBA member
+        in file order on its strongest key, and only the last IMBA row of
+        a membership id counts.
+    """
+    MAX_PARTITIONS = 64 # Per rule and side, each one is an open file while partitioning
+    SPLIT          = 16 # Sub-partitions for a partition over the budget
+    MAX_DEPTH      = 3
+    EXPANSION      = 6  # Memory of a partition loaded in a dict, per byte of spill file
+
+    def __init__(self, amba_members, imba_members, directory, budget_mb=256, amba_size=None):
+        self._dir    = directory
+        self._budget = budget_mb << 20
+        self._hits   = dict()  # { <imba row>: (<rule order>, <imba_id>, <amba_id>), ... }
+        self._superseded = set() # IMBA rows whose membership id appears again later
+        self._splits = 0
+
+        partitions = 1
+        if amba_size is not None:
+            partitions = min(self.MAX_PARTITIONS, amba_size * self.EXPANSION // self._budget + 1)
+        self._partitions = partitions
+
+        self._partition(amba_members, imba_members)
+        self._join_all()
+
+    @property
+    def matches(self): # { <imba_id>: (<rule>, <amba_id>), ... } Same as AllMembers.matches
+        matches = dict()
+        for row in sorted(self._hits):
+            if row not in self._superseded:
+                order, imba_id, amba_id = self._hits[row]
+                matches[imba_id] = (MemberIndex.RULES[order], amba_id)
+        return matches
+
+    @property
+    def superseded(self): # IMBA rows (0 based) replaced by a later row with the same membership id
+        return self._superseded
+
+    def latest(self, imba_members):
+        """ Members of the same IMBA stream again without the superseded rows
+        """
+        for row, member in enumerate(imba_members):
+            if row not in self._superseded:
+                yield member
+
+    def _fname(self, side, rule, partition):
+        return os.path.join(self._dir, "%s_%s_%03d.csv" % (side, rule, partition))
+
+    @timed
+    def _partition(self, amba_members, imba_members):
+        log.info(" - Partitioning members by match key into %s partitions per key." % self._partitions)
+        for side, members in (("amba", amba_members), ("imba", imba_members)):
+            files = dict()
+            writers = dict()
+            for rule in MemberIndex.RULES:
+                for partition in range(self._partitions):
+                    fd = open(self._fname(side, rule, partition), 'w', newline='', encoding='utf-8')
+                    files[(rule, partition)] = fd
+                    writers[(rule, partition)] = csv.writer(fd)
+            progress = log.progress("Partitioned %s" % side.upper())
+            try:
+                rows = 0
+                for row, member in enumerate(members):
+                    keys = MemberIndex.keys(member)
+                    if side == "imba" and not member.membership_id:
+                        keys.insert(0, ("id", "")) # Still needed to spot superseded rows
+                    for rule, key in keys:
+                        partition = hash(key) % self._partitions
+                        writers[(rule, partition)].writerow((key, row, member.membership_id))
+                    rows += 1
+                    if not rows & Progress.EVERY:
+                        progress.update(rows)
+            finally:
+                for fd in files.values():
+                    fd.close()
+            log.info("   + %s %s rows partitioned." % (rows, side.upper()))
+            metrics.count(side + "_rows", rows)
+
+    @timed
+    def _join_all(self):
+        for order, rule in enumerate(MemberIndex.RULES):
+            for partition in range(self._partitions):
+                self._join(order, self._fname("amba", rule, partition), self._fname("imba", rule, partition), 0)
+        log.info(" - %s IMBA rows matched, %s partitions split to fit %s MB." \
+                % (len(self._hits), self._splits, self._budget >> 20))
+        metrics.count("hits", len(self._hits))
+        metrics.count("splits", self._splits)
+
+    def _join(self, order, amba_fname, imba_fname, depth):
+        """ Join one partition pair, splitting it first when it won't fit
+        """
+        size = os.path.getsize(amba_fname)
+        if order == 0: # The id partitions also track the IMBA ids
+            size += os.path.getsize(imba_fname)
+        if size * self.EXPANSION > self._budget and depth < self.MAX_DEPTH:
+            self._splits += 1
+            parts = [self._split(fname, depth + 1) for fname in (amba_fname, imba_fname)]
+            for amba_part, imba_part in zip(*parts):
+                self._join(order, amba_part, imba_part, depth + 1)
+            return
+
+        first = dict() # { <key>: <amba_id>, ... } First AMBA member with the key
+        for key, row, amba_id in self._read(amba_fname):
+            if key not in first:
+                first[key] = amba_id
+        os.remove(amba_fname)
+
+        last = dict() # { <imba_id>: <imba row>, ... }
+        for key, row, imba_id in self._read(imba_fname):
+            row = int(row)
+            if order == 0:
+                if key in last:
+                    self._superseded.add(last[key])
+                last[key] = row
+            amba_id = first.get(key)
+            if amba_id is not None:
+                hit = self._hits.get(row)
+                if hit is None or order < hit[0]:
+                    self._hits[row] = (order, imba_id, amba_id)
+        os.remove(imba_fname)
+
+    def _split(self, fname, depth):
+        """ Split a partition file into SPLIT files by a hash salted with
+            depth, keeping row order within each
+        """
+        names = ["%s.%s" % (fname, part) for part in range(self.SPLIT)]
+        files = [open(name, 'w', newline='', encoding='utf-8') for name in names]
+        try:
+            writers = [csv.writer(fd) for fd in files]
+            for record in self._read(fname):
+                writers[hash((depth, record[0])) % self.SPLIT].writerow(record)
+        finally:
+            for fd in files:
+                fd.close()
+        os.remove(fname)
+        return names
+
+    @staticmethod
+    def _read(fname):
+        with open(fname, newline='', encoding='utf-8') as fd:
+            yield from csv.reader(fd)
+
+
+################## INCREMENTAL RUNS ###########################################
+class IncrementalState(object):
+    """ What the previous run saw, so the next run only has to look at
+        rows that changed since then:
+          - A content hash of every AMBA and IMBA row
+          - The duplicate match of every IMBA row (None if it was new),
+            household and fuzzy matches are never carried over since
+            they depend on rows that could have changed
+          - Whether each IMBA row was exported, a new member left out by
+            --expiring-within can enter the window without its row
+            changing
+
+        State is only reused when the settings that change results are
+        the same, otherwise the run falls back to checking every row.
+    """
+    VERSION = 2
+
+    def __init__(self, fname, fuzzy=None, households=False):
+        self._fname    = fname
+        self._settings = {"version": self.VERSION, "fuzzy": fuzzy, "households": households}
+        self._amba     = dict() # { <member_id>: <row hash>, ... }
+        self._imba     = dict() # { <member_id>: [<row hash>, <rule>, <amba_id>, <exported>], ... }
+        self._loaded   = False
+
+        if os.path.isfile(fname):
+            with gzip.open(fname, 'rt') as fd:
+                state = json.load(fd)
+            if state["settings"] == self._settings:
+                self._amba = state["amba"]
+                self._imba = state["imba"]
+                self._loaded = True
+                log.info(" - Loaded previous run state from %s." % fname)
+            else:
+                log.info(" - Settings changed since the state in %s was saved, checking every member." % fname)
+        else:
+            log.info(" - No previous run state in %s, checking every member." % fname)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def delta(self, amba_members, imba_members, fuzzy=None):
+        """ Return (check_ids, carried)
+            - check_ids: IMBA ids in file order whose result may differ
+              from the previous run
+            - carried: { <imba_id>: (<rule>, <amba_id>), ... } previous
+              duplicates that still hold
+        """
+        changed_amba = dict() # { <member_id>: AMBAMember, ... } Added or changed
+        for member_id, row_hash in amba_members.hashes.items():
+            if self._amba.get(member_id) != row_hash:
+                changed_amba[member_id] = amba_members.members[member_id]
+        removed_amba = set(self._amba).difference(amba_members.hashes)
+
+        check = set()
+        for member_id, row_hash in imba_members.hashes.items():
+            previous = self._imba.get(member_id)
+            if previous is None or previous[0] != row_hash:
+                check.add(member_id) # Added or changed IMBA row
+            elif previous[2] in changed_amba or previous[2] in removed_amba:
+                check.add(member_id) # Matched an AMBA row that changed or went away
+            elif previous[1] == "household":
+                check.add(member_id) # Bundles are worked out again every run
+
+        # Unchanged IMBA rows that could now match a new or changed AMBA row
+        for member in changed_amba.values():
+            for rule, key in MemberIndex.keys(member):
+                check.update(imba_members.index.lookup(rule, key))
+        # A fuzzy match depends on every AMBA row, not just the changed
+        # ones: email pieces are picked by how rare they are and large
+        # blocks are dropped. Every row without an exact match is scored
+        # again
+        if fuzzy is not None:
+            for member_id in imba_members.members:
+                if self._imba.get(member_id, [None, None])[1] in (None, "fuzzy"):
+                    check.add(member_id)
+
+        carried = dict()
+        for member_id in imba_members.members:
+            if member_id not in check and self._imba[member_id][1] is not None:
+                carried[member_id] = tuple(self._imba[member_id][1:3])
+        return [member_id for member_id in imba_members.members if member_id in check], carried
+
+    def changed(self, member_id, hashes):
+        """ True if an IMBA member wasn't exported as new last run, or its
+            row changed since then
+        """
+        previous = self._imba.get(member_id)
+        return previous is None or not previous[3] or previous[0] != hashes.get(member_id)
+
+    def save(self, amba_members, imba_members, matches, exported):
+        """ Save this run's row hashes, matches and the ids of the new
+            members exported for the next run
+        """
+        imba = dict()
+        for member_id, row_hash in imba_members.hashes.items():
+            rule, amba_id = matches.get(member_id, (None, None))
+            imba[member_id] = [row_hash, rule, amba_id, member_id in exported]
+        state = {"settings": self._settings, "amba": amba_members.hashes, "imba": imba}
+
+        tmp = self._fname + ".tmp"
+        with gzip.open(tmp, 'wt') as fd:
+            json.dump(state, fd, separators=(",", ":"))
+        os.replace(tmp, self._fname)
+        log.info(" - Saved run state to %s." % self._fname)
+
+
+################## INPUT ARCHIVE ##############################################
+FICLONE = 0x40049409 # Linux ioctl to share the blocks of one file with another (reflink)
+
+class InputArchive(object):
+    """ Content addressed store of the export files
+        - Each distinct export is stored once as <sha256><extension>
+        - Archived files are read only, runs link to them rather than
+          copying them
+        - Hashes are remembered by path, size, mtime and inode, so handing
+          in the same unchanged file again costs a stat, not a read
+    """
+    def __init__(self, directory):
+        self._dir   = directory
+        self._fname = os.path.join(directory, "index.json")
+        self._index = dict() # { <source path>: [<size>, <mtime_ns>, <inode>, <sha256>], ... }
+
+        os.makedirs(directory, exist_ok=True)
+        if os.path.isfile(self._fname):
+            with open(self._fname) as fd:
+                self._index = json.load(fd)
+
+    @property
+    def directory(self):
+        return self._dir
+
+    def digest(self, fname):
+        """ sha256 of a file's content, from the index when the file hasn't
+            changed since it was last hashed
+        """
+        fname = os.path.abspath(fname)
+        st = os.stat(fname)
+        signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+        cached = self._index.get(fname)
+        if cached is not None and cached[:3] == signature:
+            return cached[3]
+
+        sha = hashlib.sha256()
+        with open(fname, 'rb') as fd:
+            for block in iter(lambda: fd.read(1 << 20), b""):
+                sha.update(block)
+        self._index[fname] = signature + [sha.hexdigest()]
+        self._save_index()
+        return sha.hexdigest()
+
+    def store(self, fname):
+        """ Archive fname if its content isn't archived yet, returns the
+            archived path
+        """
+        name = os.path.basename(fname)
+        extension = name[name.index("."):] if "." in name else ""
+        archived = os.path.join(self._dir, self.digest(fname) + extension)
+        if not os.path.isfile(archived):
+            tmp = archived + ".tmp"
+            clone_file(fname, tmp)
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, archived)
+            log.info(" - Archived %s as %s" % (fname, archived))
+        else:
+            log.info(" - %s is already archived as %s" % (fname, archived))
+        return archived
+
+    def link(self, fname, dest):
+        """ Archive fname and make dest refer to the archived copy
+        """
+        archived = self.store(fname)
+        try:
+            os.link(archived, dest)
+        except OSError: # Different file system or no hard links
+            clone_file(archived, dest)
+
+        # The link has the archived content, remember its hash too
+        st = os.stat(dest)
+        self._index[os.path.abspath(dest)] = [st.st_size, st.st_mtime_ns, st.st_ino, self.digest(fname)]
+        self._save_index()
+
+    def _save_index(self):
+        tmp = self._fname + ".tmp"
+        with open(tmp, 'w') as fd:
+            json.dump(self._index, fd)
+        os.replace(tmp, self._fname)
+
+def clone_file(src, dest):
+    """ Copy src to dest, sharing the data blocks (reflink) where the file
+        system supports it
+    """
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+                fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError: # File system can't share blocks
+            pass
+    shutil.copyfile(src, dest)
 
 
 class InitialSetup(object):
-    """ Setup the directorie for the output and copy the source CSV files there
+    """ Setup the directory for the output and link the source CSV files
+        there from the input archive
+        - An earlier run's directory for today is kept, renamed with the
+          time it finished
     """
-    def __init__(self, amba_file, imba_file):
-        self._dir = os.path.join(os.getcwd(), time.strftime("%Y_%m_%d"))
-        self._amba_file = os.path.join(self._dir, os.path.relpath(amba_file))
-        self._imba_file = os.path.join(self._dir, os.path.relpath(imba_file))
+    def __init__(self, amba_file, imba_files, root=None):
+        root = root or os.getcwd()
+        if isinstance(imba_files, str):
+            imba_files = [imba_files]
+        self._sources    = [amba_file] + list(imba_files)
+        self._archive    = InputArchive(os.path.join(root, "archive"))
+        self._dir        = os.path.join(root, time.strftime("%Y_%m_%d"))
+        self._amba_file  = os.path.join(self._dir, os.path.basename(amba_file))
+        self._imba_files = list()
+
+        # Exports from different folders may share a name
+        names = set([os.path.basename(amba_file)])
+        for fname in imba_files:
+            base, extension = os.path.splitext(os.path.basename(fname))
+            name, count = base + extension, 1
+            while name in names:
+                count += 1
+                name = "%s_%s%s" % (base, count, extension)
+            names.add(name)
+            self._imba_files.append(os.path.join(self._dir, name))
 
     def __call__(self):
         if os.path.isdir(self._dir):
-            print(" - %s already exists. Deleting ..." % self._dir)
-            shutil.rmtree(self._dir)  
-
-        print(" - Creating output directory %s" % self._dir)  
+            finished = time.strftime("_%H%M%S", time.localtime(os.path.getmtime(self._dir)))
+            previous = self._dir + finished
+            count = 1
+            while os.path.exists(previous):
+                count += 1
+                previous = "%s%s_%s" % (self._dir, finished, count)
+            log.info(" - %s already exists. Keeping it as %s" % (self._dir, previous))
+            os.rename(self._dir, previous)
+
+        log.info(" - Creating output directory %s" % self._dir)  
         os.mkdir(self._dir)
 
-        print(" - Copying the membership files to the output directory.")
-        shutil.copyfile(amba_file, self._amba_file)
-        shutil.copyfile(imba_file, self._imba_file)
+        log.info(" - Linking the membership files from %s." % self._archive.directory)
+        for source, dest in zip(self._sources, [self._amba_file] + self._imba_files):
+            self._archive.link(source, dest)
 
     @property
     def amba_file(self):
@@ -603,15 +2774,638 @@ class InitialSetup(object):
 
     @property
     def imba_file(self):
-        return self._imba_file
+        return self._imba_files[0]
+
+    @property
+    def imba_files(self):
+        return self._imba_files
 
     @property
     def directory(self):
         return self._dir
+
+    @property
+    def archive(self):
+        return self._archive
     
 
+################## SNAPSHOT CACHE #############################################
+class SnapshotCache(object):
+    """ Parsed members saved by the content of their export, so reruns on
+        the same export load them rather than parsing it again
+        - Keyed by the export's sha256, the Members class, whether row
+          hashes were kept and a hash of this script, so a changed export
+          or changed parsing and normalization rules miss
+        - A snapshot is a pickle of plain lists, dicts and strings, read
+          through mmap
+        - The least recently used snapshots are removed once the cache is
+          larger than max_mb
+    """
+    VERSION = 1
+
+    def __init__(self, directory, archive, max_mb=1024):
+        self._dir     = directory
+        self._archive = archive # InputArchive, already knows the hashes of the exports it linked
+        self._max     = max_mb << 20
+        self._lock    = threading.Lock() # Both exports are parsed at once with workers
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def fingerprint():
+        """ Hash of this script, which holds the parsing and normalization
+            rules, so any change to it misses the old snapshots
+        """
+        sha = hashlib.sha256(str(SnapshotCache.VERSION).encode())
+        with open(os.path.abspath(__file__), 'rb') as fd:
+            sha.update(fd.read())
+        return sha.hexdigest()[:16]
+
+    def _fname(self, members):
+        with self._lock:
+            digest = self._archive.digest(members._members_file)
+        name = "%s_%s_%s%s.snapshot" % (type(members).__name__, digest[:32], self.fingerprint(),
+                                         "_hashes" if members._hash else "")
+        return os.path.join(self._dir, name)
+
+    def load(self, members):
+        """ Restore members from their snapshot, False when there isn't one
+        """
+        fname = self._fname(members)
+        if not os.path.isfile(fname):
+            log.info(" - No snapshot of %s, parsing it." % members._members_file)
+            metrics.count("snapshot", "miss")
+            return False
+
+        # Nothing restored can form a cycle, so the collector is paused
+        # rather than left to walk every new member over and over
+        gc.disable()
+        try:
+            with open(fname, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                members.restore(pickle.loads(data))
+        finally:
+            gc.enable()
+        os.utime(fname) # Recently used
+        log.info(" - Loaded from snapshot %s" % fname)
+        metrics.count("snapshot", "hit")
+        return True
+
+    def store(self, members):
+        """ Save the snapshot of members just parsed, then evict
+        """
+        fname = self._fname(members)
+        tmp = "%s.%s.tmp" % (fname, threading.get_ident())
+        with open(tmp, 'wb') as fd:
+            pickle.dump(members.snapshot(), fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fname)
+        log.info(" - Saved snapshot %s" % fname)
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        snapshots = list()
+        for name in os.listdir(self._dir):
+            if name.endswith(".snapshot"):
+                st = os.stat(os.path.join(self._dir, name))
+                snapshots.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in snapshots)
+        for mtime, size, name in sorted(snapshots): # Oldest first
+            if total <= self._max:
+                break
+            os.remove(os.path.join(self._dir, name))
+            total -= size
+            log.info(" - Evicted snapshot %s" % name)
+
+
+################## HISTORY ####################################################
+class History(object):
+    """ SQLite store of every run, kept across runs to answer questions
+        about past exports:
+          - runs: one row per run with its date and input files
+          - members: every member seen, by source, with the first and last
+            run date it was seen on
+          - matches: each run's duplicates and the rule that matched them
+          - exports: which output files each new member was written to
+
+        Each run is recorded in one transaction with bulk upserts.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id      INTEGER PRIMARY KEY,
+            run_date    TEXT NOT NULL,
+            started     TEXT NOT NULL,
+            directory   TEXT,
+            amba_file   TEXT,
+            amba_sha256 TEXT,
+            imba_file   TEXT,
+            imba_sha256 TEXT
+        );
+        CREATE TABLE IF NOT EXISTS members (
+            source        TEXT NOT NULL,
+            membership_id TEXT NOT NULL,
+            email         TEXT,
+            first_name    TEXT,
+            last_name     TEXT,
+            postal_code   TEXT,
+            member_term   TEXT,
+            auto_renew    TEXT,
+            first_seen    TEXT NOT NULL,
+            last_seen     TEXT NOT NULL,
+            last_run_id   INTEGER NOT NULL,
+            PRIMARY KEY (source, membership_id)
+        );
+        CREATE TABLE IF NOT EXISTS matches (
+            run_id        INTEGER NOT NULL REFERENCES runs,
+            membership_id TEXT NOT NULL,
+            rule          TEXT NOT NULL,
+            amba_id       TEXT,
+            PRIMARY KEY (run_id, membership_id)
+        );
+        CREATE TABLE IF NOT EXISTS exports (
+            run_id        INTEGER NOT NULL REFERENCES runs,
+            export        TEXT NOT NULL,
+            membership_id TEXT NOT NULL,
+            PRIMARY KEY (run_id, export, membership_id)
+        );
+        CREATE INDEX IF NOT EXISTS runs_date      ON runs (run_date);
+        CREATE INDEX IF NOT EXISTS members_id     ON members (membership_id);
+        CREATE INDEX IF NOT EXISTS members_email  ON members (email);
+        CREATE INDEX IF NOT EXISTS matches_id     ON matches (membership_id);
+        CREATE INDEX IF NOT EXISTS exports_id     ON exports (membership_id);
+        CREATE INDEX IF NOT EXISTS exports_export ON exports (export, membership_id);
+    """
+
+    UPSERT_MEMBER = """
+        INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (source, membership_id) DO UPDATE SET
+            email=excluded.email, first_name=excluded.first_name,
+            last_name=excluded.last_name, postal_code=excluded.postal_code,
+            member_term=excluded.member_term, auto_renew=excluded.auto_renew,
+            last_seen=excluded.last_seen, last_run_id=excluded.last_run_id
+    """
+
+    def __init__(self, fname):
+        self._fname = fname
+        self._db = sqlite3.connect(fname)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    @timed
+    def record(self, setup, amba_members, imba_members, all_members, started):
+        """ Add one run: its members, duplicates and exports
+        """
+        run_date = started[:10]
+        archive = setup.archive
+        with self._db:
+            run_id = self._db.execute(
+                "INSERT INTO runs (run_date, started, directory, amba_file, amba_sha256, imba_file, imba_sha256)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (run_date, started, setup.directory,
+                 setup.amba_file, archive.digest(setup.amba_file),
+                 setup.imba_file, archive.digest(setup.imba_file))).lastrowid
+
+            for source, members in (("amba", amba_members.members), ("imba", imba_members.members)):
+                self._db.executemany(self.UPSERT_MEMBER, (
+                    (source, m.membership_id, normalize_email(m.email), m.first_name, m.last_name,
+                     m.postal_code, getattr(m, "member_term", None), getattr(m, "auto_renew", None),
+                     run_date, run_date, run_id) for m in members.values()))
+
+            self._db.executemany("INSERT INTO matches VALUES (?, ?, ?, ?)", (
+                (run_id, imba_id, rule, amba_id) for imba_id, (rule, amba_id) in all_members.matches.items()))
+
+            self._db.executemany("INSERT INTO exports VALUES (?, ?, ?)", (
+                (run_id, os.path.splitext(name)[0], member.membership_id)
+                for member in all_members.new_members for name in all_members.exports(member)))
+
+        metrics.count("rows", len(amba_members.members) + len(imba_members.members))
+        log.info(" - Run %s recorded in %s" % (run_id, self._fname))
+        return run_id
+
+    def member_ids(self, key):
+        """ Membership ids for a membership id or an email address
+        """
+        if "@" in key:
+            rows = self._db.execute("SELECT DISTINCT membership_id FROM members WHERE email = ?",
+                                    (normalize_email(key),))
+            return [row[0] for row in rows]
+        return [key]
+
+    def first_new(self, key):
+        """ [(membership_id, run_date), ...] the first run each member was
+            exported as new
+        """
+        return self._db.execute(
+            "SELECT e.membership_id, MIN(r.run_date) FROM exports e JOIN runs r USING (run_id)"
+            " WHERE e.export = 'new_all' AND e.membership_id IN (SELECT value FROM json_each(?))"
+            " GROUP BY e.membership_id ORDER BY 2",
+            (json.dumps(self.member_ids(key)),)).fetchall()
+
+    def added_per_month(self, export="new_all"):
+        """ [(YYYY-MM, count), ...] members first written to an export,
+            per month
+        """
+        return self._db.execute(
+            "SELECT substr(first_date, 1, 7), COUNT(*) FROM ("
+            "  SELECT MIN(r.run_date) AS first_date FROM exports e JOIN runs r USING (run_id)"
+            "  WHERE e.export = ? GROUP BY e.membership_id)"
+            " GROUP BY 1 ORDER BY 1", (export,)).fetchall()
+
+    def timeline(self, key):
+        """ [(started, membership_id, result), ...] what each run did with
+            a member: the rule that matched it or the files it was exported to
+        """
+        ids = json.dumps(self.member_ids(key))
+        return self._db.execute(
+            "SELECT r.started, m.membership_id, 'duplicate by ' || m.rule || ' of ' || ifnull(m.amba_id, '')"
+            " FROM matches m JOIN runs r USING (run_id) WHERE m.membership_id IN (SELECT value FROM json_each(?))"
+            " UNION ALL"
+            " SELECT r.started, e.membership_id, 'exported to ' || group_concat(e.export, ', ')"
+            " FROM exports e JOIN runs r USING (run_id) WHERE e.membership_id IN (SELECT value FROM json_each(?))"
+            " GROUP BY e.run_id, e.membership_id"
+            " ORDER BY 1, 2", (ids, ids)).fetchall()
+
+
+################## MATCH SERVICE ##############################################
+class MatchService(object):
+    """ Resident duplicate checks against exports that are parsed once
+        - Each query is one lookup in the in-memory AMBA and IMBA indexes
+          (and the fuzzy blocks when fuzzy matching is on)
+        - The exports are parsed again when their files change on disk or
+          a reload is requested; queries keep being answered from the
+          current members until the new ones are ready, then swap over
+    """
+    def __init__(self, amba_file, imba_file, fuzzy=None, workers=1):
+        self._fuzzy   = fuzzy
+        self._workers = workers
+        self._lock    = threading.Lock() # One reload at a time
+        self._loaded  = None # (<files>, <file signatures>, AMBAMembers, IMBAMembers, FuzzyMatcher or None)
+        self._reloads = 0
+        self.reload(amba_file, imba_file)
+
+    @staticmethod
+    def _signature(files):
+        return [(st.st_size, st.st_mtime_ns, st.st_ino) for st in map(os.stat, files)]
+
+    def reload(self, amba_file=None, imba_file=None):
+        """ Parse the exports again, optionally from new files
+        """
+        with self._lock:
+            files = [os.path.abspath(fname) for fname in (
+                amba_file or self._loaded[0][0], imba_file or self._loaded[0][1])]
+            signature = self._signature(files)
+            amba = AMBAMembers(files[0], workers=self._workers)
+            imba = IMBAMembers(files[1], workers=self._workers)
+            matcher = None
+            if self._fuzzy is not None:
+                matcher = FuzzyMatcher(amba.members, threshold=self._fuzzy)
+            self._loaded = (files, signature, amba, imba, matcher) # Swapped in one assignment
+            self._reloads += 1
+        log.info(" - Loaded %s AMBA and %s IMBA members." % (len(amba.members), len(imba.members)))
+        return self.status()
+
+    def reload_if_changed(self):
+        """ Reload when either export file changed, True if it did
+        """
+        files, signature = self._loaded[:2]
+        try:
+            if self._signature(files) == signature:
+                return False
+        except OSError: # File is being replaced, try again next time
+            return False
+        log.info(" - Export files changed, reloading.")
+        self.reload()
+        return True
+
+    def watch(self, interval):
+        """ Check the export files for changes every interval seconds in a
+            background thread
+        """
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload_if_changed()
+                except (Exception, SystemExit) as err: # Keep serving the members already loaded
+                    log.error(" - Reload failed: %s" % err)
+        thread = threading.Thread(target=poll, name="itoa-watch", daemon=True)
+        thread.start()
+        return thread
+
+    def status(self):
+        files, signature, amba, imba, matcher = self._loaded
+        return {"amba_file": files[0], "imba_file": files[1], "amba_members": len(amba.members),
+                "imba_members": len(imba.members), "fuzzy": self._fuzzy, "reloads": self._reloads}
+
+    def match(self, query):
+        """ Which AMBA member (and IMBA member) a query's fields match
+            {"duplicate": bool, "amba": {"rule", "membership_id"} or None,
+             "imba": {"rule", "membership_id"} or None}
+        """
+        files, signature, amba, imba, matcher = self._loaded
+        member = AMBAMember(**dict((name, str(query.get(name) or "")) for name in AMBAMember.fields()))
+
+        result = {"duplicate": False, "amba": None, "imba": None}
+        match = amba.index.match(member)
+        if match is None and matcher is not None:
+            fuzzy = matcher.match(member)
+            if fuzzy is not None:
+                match = ("fuzzy", fuzzy[1])
+        if match is not None:
+            result["duplicate"] = True
+            result["amba"] = {"rule": match[0], "membership_id": match[1]}
+        match = imba.index.match(member)
+        if match is not None:
+            result["imba"] = {"rule": match[0], "membership_id": match[1]}
+        return result
+
+    def handle(self, request):
+        """ Answer one request, the same for JSON lines and HTTP
+            {"command": "match" (default) | "reload" | "status", ...}
+        """
+        start = time.perf_counter()
+        if not isinstance(request, dict): # A JSON list, string or number
+            return {"error": "Bad request: expected a JSON object",
+                    "elapsed_ms": round((time.perf_counter() - start) * 1000, 3)}
+        command = request.get("command", "match")
+        try:
+            if command == "match":
+                response = self.match(request)
+            elif command == "reload":
+                response = self.reload(request.get("amba_file"), request.get("imba_file"))
+            elif command == "status":
+                response = self.status()
+            else:
+                response = {"error": "Unknown command %s" % command}
+        except (OSError, SystemExit) as err: # Missing file or bad export on reload
+            response = {"error": "%s failed: %s" % (command, err)}
+        if "id" in request:
+            response["id"] = request["id"]
+        response["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        return response
+
+    def serve_lines(self, infile, outfile):
+        """ One JSON request per input line, one JSON response per output
+            line, in the same order
+        """
+        for line in infile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as err:
+                response = {"error": "Bad request: %s" % err}
+            else:
+                response = self.handle(request)
+            outfile.write(json.dumps(response) + "\n")
+            outfile.flush()
+
+    def serve_http(self, host, port):
+        """ GET /match?<field>=<value>&..., GET /status, POST /<command>
+            with a JSON request body
+        """
+        service = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                request = dict(urllib.parse.parse_qsl(url.query))
+                request["command"] = url.path.strip("/") or "status"
+                self._respond(service.handle(request))
+
+            def do_POST(self):
+                url = urllib.parse.urlsplit(self.path)
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                except ValueError as err:
+                    return self._respond({"error": "Bad request: %s" % err}, 400)
+                if not isinstance(request, dict):
+                    return self._respond(service.handle(request), 400)
+                request["command"] = url.path.strip("/") or "match"
+                self._respond(service.handle(request))
+
+            def _respond(self, response, code=None):
+                body = json.dumps(response).encode("utf-8")
+                self.send_response(code or (400 if "error" in response else 200))
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args): # Requests aren't logged
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        log.info(" - Serving on http://%s:%s/" % server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+
+
+################## WATCH FOLDER ###############################################
+def export_type(fname):
+    """ "amba" or "imba" from an export's header, None for any other file.
+        Only the critical columns are needed, as for a run
+    """
+    try:
+        with open_export(fname) as fd:
+            header = set(next(csv.reader(fd), []))
+    except Exception: # Not text, not CSV or a broken compressed file
+        return None
+    if header.issuperset(IMBAMembers.critical_fields()):
+        return "imba"
+    if header.issuperset(AMBAMembers.critical_fields()):
+        return "amba"
+    return None
+
+
+class WatchFolder(object):
+    """ Daemon that runs the exports dropped into a folder
+        - The folder is polled, a file is picked up once it hasn't been
+          modified for settle seconds, so files still being copied are
+          left alone. Hidden and temporary (.tmp, .part...) names are
+          never picked up
+        - Exports are told apart by their header
+        - New files are queued, a run starts once no file is still
+          settling and handles everything queued with the latest AMBA and
+          latest IMBA export, so a burst of files makes one run
+        - Parsed exports are kept in memory, a run only parses the side
+          that has a new file
+        - Results go to dated directories under root, like a run
+    """
+    TEMPORARY = (".tmp", ".part", ".partial", ".crdownload", ".swp")
+
+    def __init__(self, directory, root, settle=5.0, fuzzy=None, compress=None, workers=1):
+        self._dir      = os.path.abspath(directory)
+        self._root     = os.path.abspath(root)
+        self._settle   = settle
+        self._fuzzy    = fuzzy
+        self._compress = compress
+        self._workers  = workers
+        self._exports  = dict() # { <path>: (<type>, <signature>), ... } Settled files, None type if not an export
+        self._loaded   = dict() # { <type>: (<path>, <signature>, Members), ... } Exports held in memory
+        self._pending  = list() # New exports since the last run
+        self._settling = 0      # Files seen on the last poll that are still being written
+        self._runs     = 0
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def runs(self):
+        return self._runs
+
+    def poll(self):
+        """ Scan the folder once, queue the exports that settled since
+            the last scan
+        """
+        now = time.time()
+        present = set()
+        self._settling = 0
+        for entry in os.scandir(self._dir):
+            if entry.name.startswith(".") or entry.name.endswith(self.TEMPORARY) or not entry.is_file():
+                continue
+            present.add(entry.path)
+            st = entry.stat()
+            signature = (st.st_size, st.st_mtime_ns)
+            known = self._exports.get(entry.path)
+            if known is not None and known[1] == signature:
+                continue
+            if now - st.st_mtime < self._settle:
+                self._settling += 1
+                continue
+
+            kind = export_type(entry.path)
+            self._exports[entry.path] = (kind, signature)
+            if kind is None:
+                log.info(" - Ignoring %s, not an AMBA or IMBA export." % entry.path)
+            else:
+                log.info(" - New %s export %s" % (kind.upper(), entry.path))
+                self._pending.append(entry.path)
+
+        for fname in set(self._exports).difference(present): # Removed since the last scan
+            del self._exports[fname]
+        self._pending = [fname for fname in self._pending if fname in present]
+
+    def latest(self, kind):
+        """ Most recently modified export of a type, None if there isn't one
+        """
+        exports = [(signature[1], fname) for fname, (export, signature) in self._exports.items() if export == kind]
+        return max(exports)[1] if exports else None
+
+    def run_pending(self):
+        """ One run for everything queued, once nothing is settling and
+            both types of export are there, returns its output directory
+        """
+        if not self._pending or self._settling:
+            return None
+        amba_file, imba_file = self.latest("amba"), self.latest("imba")
+        if amba_file is None or imba_file is None:
+            return None # Wait for the other export
+
+        log.info(" - Running %s and %s for %s new files." % (amba_file, imba_file, len(self._pending)))
+        self._pending = list()
+        try:
+            return self._run(amba_file, imba_file)
+        except (Exception, SystemExit) as err: # Bad export, keep watching for the next one
+            log.error(" - Run failed: %s" % err)
+            return None
+
+    def _members(self, kind, source, fname):
+        """ Members of an export, parsed again only if its file is new
+        """
+        signature = self._exports[source][1]
+        loaded = self._loaded.get(kind)
+        if loaded is not None and loaded[:2] == (source, signature):
+            log.info(" - %s members from %s already loaded." % (kind.upper(), source))
+            return loaded[2]
+        members = (AMBAMembers if kind == "amba" else IMBAMembers)(fname, workers=self._workers)
+        self._loaded[kind] = (source, signature, members)
+        return members
+
+    def _run(self, amba_file, imba_file):
+        setup = InitialSetup(amba_file, imba_file, root=self._root)
+        setup()
+        started = time.strftime("%Y-%m-%dT%H:%M:%S")
+        metrics.reset()
+        log.open(os.path.join(setup.directory, "itoa.log"))
+        quarantine.open(os.path.join(setup.directory, "rejected.csv"))
+        try:
+            amba_members = self._members("amba", amba_file, setup.amba_file)
+            imba_members = self._members("imba", imba_file, setup.imba_file)
+            AllMembers(amba_members=amba_members, imba_members=imba_members, directory=setup.directory,
+                       fuzzy=self._fuzzy, compress=self._compress)
+            metrics.save(os.path.join(setup.directory, "metrics.json"), started=started, amba_file=amba_file,
+                         imba_files=[imba_file], options={"watch": self._dir, "fuzzy": self._fuzzy})
+        finally:
+            quarantine.close()
+            log.close()
+        self._runs += 1
+        log.info(" - Results published to %s" % setup.directory)
+        return setup.directory
+
+    def watch(self, interval, once=False):
+        """ Poll every interval seconds until interrupted, or only until
+            the files already there are handled when once is set
+        """
+        log.info(" - Watching %s every %s s, output to %s" % (self._dir, interval, self._root))
+        try:
+            while True:
+                self.poll()
+                self.run_pending()
+                if once and not self._settling:
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
 ################## MAIN #######################################################
-if __name__ == "__main__":
+def add_log_arguments(parser):
+    """ --quiet and --verbose, both setting log_level
+    """
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-q', '--quiet', dest='log_level', action='store_const', const=Log.QUIET,
+                       default=Log.INFO, help='Only show errors on the console')
+    group.add_argument('-v', '--verbose', dest='log_level', action='store_const', const=Log.VERBOSE,
+                       help='Also show each new member and fuzzy match on the console, not only in itoa.log')
+
+def fuzzy_threshold(value):
+    """ argparse type for a name similarity above 0 and at most 1
+    """
+    try:
+        threshold = float(value)
+    except ValueError:
+        threshold = None
+    if threshold is None or not 0 < threshold <= 1:
+        raise argparse.ArgumentTypeError("expected a similarity above 0 and at most 1, such as 0.85")
+    return threshold
+
+def byte_size(value):
+    """ argparse type for a size in bytes with an optional K, M or G
+    """
+    match = re.match(r"^\s*(\d+)\s*([KMG]?)B?\s*$", value, re.IGNORECASE)
+    if match is None or int(match.group(1)) == 0:
+        raise argparse.ArgumentTypeError("expected a size such as 500000, 512K or 10M")
+    return int(match.group(1)) << {"": 0, "K": 10, "M": 20, "G": 30}[match.group(2).upper()]
+
+def add_quarantine_arguments(parser):
+    """ --max-rejects and --max-reject-rate
+    """
+    parser.add_argument('--max-rejects', dest='max_rejects', action='store', type=int, default=1000,
+                       metavar='ROWS', help='Rows that fail validation are set aside in rejected.csv, stop the '
+                                            'run when there are more than this (default 1000)')
+    parser.add_argument('--max-reject-rate', dest='max_reject_rate', action='store', type=float, default=0.05,
+                       metavar='FRACTION', help='Stop the run when more than this fraction of an export\'s '
+                                                'rows are rejected (default 0.05)')
+
+def run(argv=None):
     """ This program compares current IMBA members to current AMBA members.
         
         Current IMBA members that aren't AMBA members will be exported
@@ -624,45 +3418,330 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process AMBA & IMBA membership files')
     parser.add_argument('-a', '--amba', dest='amba_file', action='store', required=True,
                        help='AMBA membership file')
-    parser.add_argument('-i', '--imba', dest='imba_file', action='store', required=True,
-                       help='IMBA membership file')
+    parser.add_argument('-i', '--imba', dest='imba_files', action='store', nargs='+', required=True,
+                       metavar='IMBA_FILE',
+                       help='IMBA membership file, or several exports oldest first to merge them on disk '
+                            'keeping the latest record of each member')
+    parser.add_argument('--fuzzy', dest='fuzzy', action='store', type=fuzzy_threshold, nargs='?', const=0.85,
+                       metavar='THRESHOLD',
+                       help='Also match members with similar names within blocks of shared keys '
+                            '(default threshold 0.85)')
+    parser.add_argument('--partition-key', dest='partition_key', action='store', choices=sorted(PARTITION_KEYS),
+                       default=None, help='Split fuzzy matching by this geographic key, only members with the '
+                                          'same key are compared, and match the partitions on --workers processes')
+    parser.add_argument('--shard-rows', dest='shard_rows', action='store', type=int, default=None, metavar='ROWS',
+                       help='Split each new_*.csv file into shards of at most this many rows, '
+                            'new_all_0001.csv, new_all_0002.csv...')
+    parser.add_argument('--shard-size', dest='shard_bytes', action='store', type=byte_size, default=None,
+                       metavar='SIZE', help='Split each new_*.csv file into shards of at most this much CSV '
+                                            'before compression, e.g. 10M')
+    parser.add_argument('--shard-key', dest='shard_key', action='store', choices=sorted(SHARD_KEYS), default=None,
+                       help='Also split the new_*.csv files by this key, new_all_CO_0001.csv...')
+    parser.add_argument('--expiring-within', dest='expiring', action='store', type=int, default=None,
+                       metavar='DAYS', help='Only export new members whose renewal is due in the next DAYS days')
+    parser.add_argument('--households', dest='households', action='store_true',
+                       help='Treat members linked by Parent Membership ID as one household: if any of them '
+                            'is already an AMBA member none are exported, new ones are written grouped by bundle')
+    parser.add_argument('--compress', dest='compress', action='store', choices=sorted(COMPRESSION),
+                       default=None, help='Write the new_*.csv files compressed (.gz, .bz2 or .xz). '
+                                          'Compressed inputs are always read directly')
+    parser.add_argument('--cache', dest='cache_dir', action='store', nargs='?', const='itoa_cache',
+                       metavar='CACHE_DIR', help='Load parsed exports from snapshots in CACHE_DIR when the same '
+                                                 'export was parsed before, and save new ones (default itoa_cache)')
+    parser.add_argument('--cache-size', dest='cache_mb', action='store', type=int, default=1024, metavar='MB',
+                       help='Remove the least recently used snapshots past this size (default 1024)')
+    parser.add_argument('--memory-budget', dest='budget', action='store', type=int, default=None,
+                       metavar='MB', help='Find duplicates out of core: partition both exports to disk by '
+                                          'match key and join the partitions within this much memory')
+    parser.add_argument('--run-size', dest='run_size', action='store', type=int, default=200000,
+                       metavar='ROWS', help='Rows sorted in memory at a time when merging several IMBA '
+                                            'exports (default 200000)')
+    parser.add_argument('--incremental', dest='state_file', action='store', nargs='?',
+                       const='itoa_state.json.gz', metavar='STATE_FILE',
+                       help='Only check rows that changed since the run that saved STATE_FILE and also '
+                            'write delta_new_*.csv files (default itoa_state.json.gz)')
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                       help='Save a cProfile dump of the run to profile.pstats in the output directory')
+    parser.add_argument('--trace-memory', dest='trace_memory', action='store_true',
+                       help='Record the peak Python memory of each stage in metrics.json with tracemalloc '
+                            '(slows the run down)')
+    parser.add_argument('-w', '--workers', dest='workers', action='store', type=int, default=1,
+                       help='Read both exports at the same time and parse large files in chunks '
+                            'on this many processes (default 1)')
+    parser.add_argument('--history', dest='history_file', action='store', nargs='?',
+                       const='itoa_history.sqlite', metavar='HISTORY_FILE',
+                       help='Record the run\'s members, duplicates and exports in the SQLite database '
+                            'HISTORY_FILE, see "%(prog)s query -h" (default itoa_history.sqlite)')
+    add_log_arguments(parser)
+    add_quarantine_arguments(parser)
+
+    args = parser.parse_args(argv)
+    log.level = args.log_level
+    quarantine.max_rejects = args.max_rejects
+    quarantine.max_rate = args.max_reject_rate
+    merge = len(args.imba_files) > 1
+    if args.partition_key and (args.fuzzy is None or merge or args.state_file):
+        parser.error("--partition-key needs --fuzzy and a single IMBA file, without --incremental")
+    if merge and (args.state_file or args.history_file or args.households):
+        parser.error("--incremental, --history and --households need a single IMBA file")
+    if args.budget is not None and (args.state_file or args.history_file or args.fuzzy is not None or args.households):
+        parser.error("--incremental, --history, --fuzzy and --households need the members in memory, "
+                     "not --memory-budget")
 
-    args = parser.parse_args()
     missing_file=False
     amba_file = os.path.abspath(args.amba_file)
-    imba_file = os.path.abspath(args.imba_file)
+    imba_files = [os.path.abspath(fname) for fname in args.imba_files]
     
     if not os.path.isfile(amba_file):
-        print("Error: AMBA file %s not found." % amba_file)
-        missing_file=True
-    if not os.path.isfile(args.imba_file):
-        print("Error: IMBA file %s not found." % imba_file)
+        log.error("Error: AMBA file %s not found." % amba_file)
         missing_file=True
+    for imba_file in imba_files:
+        if not os.path.isfile(imba_file):
+            log.error("Error: IMBA file %s not found." % imba_file)
+            missing_file=True
     if missing_file:
-        sys.exit()
+        sys.exit(1)
 
-    print(" - Found membership files: %s %s " % (amba_file, imba_file))
-    setup = InitialSetup(amba_file, imba_file)
+    log.info(" - Found membership files: %s %s " % (amba_file, " ".join(imba_files)))
+    state = None
+    if args.state_file:
+        state = IncrementalState(os.path.abspath(args.state_file), fuzzy=args.fuzzy, households=args.households)
+    setup = InitialSetup(amba_file, imba_files)
     setup()
+    log.open(os.path.join(setup.directory, "itoa.log"))
+    quarantine.open(os.path.join(setup.directory, "rejected.csv"))
 
     plen = 85
-    print()
-    print("*"*plen)
-    print()
+    log.info()
+    log.info("*"*plen)
+    log.info()
+
+    profile = None
+    if args.profile:
+        profile = cProfile.Profile()
+        profile.enable()
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    metrics.reset()
     
-    amba_members = AMBAMembers(setup.amba_file)
-    print()
-    print("-"*plen)
-    print()
-    
-    imba_members = IMBAMembers(setup.imba_file)
-    print()
-    print("-"*plen)
-    print()
-
-    AllMembers(amba_members=amba_members, imba_members=imba_members, directory=setup.directory)
-    print()
-    print("*"*plen)
-    print()
+    hashes = state is not None
+    output = {"shard_rows": args.shard_rows, "shard_bytes": args.shard_bytes, "shard_key": args.shard_key,
+              "expiring": args.expiring}
+    cache = None
+    if args.cache_dir:
+        cache = SnapshotCache(os.path.abspath(args.cache_dir), setup.archive, max_mb=args.cache_mb)
+    if args.budget is not None:
+        # Neither export is held in memory, duplicates are found by joining
+        # partitions on disk and the IMBA members streamed again to export
+        with tempfile.TemporaryDirectory(prefix="partitions_", dir=setup.directory) as spill:
+            if merge:
+                imba_members = IMBAExportMerge(setup.imba_files, spill, run_size=args.run_size)
+                imba_stream = lambda: imba_members
+            else:
+                imba_stream = lambda: IMBAMembers.stream(setup.imba_file)
+            log.info()
+            log.info("-"*plen)
+            log.info()
+
+            log.info(" Finding duplicate members out of core.")
+            matcher = PartitionedMatcher(AMBAMembers.stream(setup.amba_file), imba_stream(), spill,
+                                         budget_mb=args.budget, amba_size=os.path.getsize(setup.amba_file))
+            log.info()
+            all_members = MergedAllMembers(amba_members=None, imba_members=matcher.latest(imba_stream()),
+                                           directory=setup.directory, matches=matcher.matches,
+                                           compress=args.compress, **output)
+    elif merge:
+        # Only AMBA is held in memory, the IMBA exports are sorted and
+        # merged on disk and streamed through matching and export
+        amba_members = AMBAMembers(setup.amba_file, workers=args.workers, cache=cache)
+        log.info()
+        log.info("-"*plen)
+        log.info()
+
+        with tempfile.TemporaryDirectory(prefix="merge_", dir=setup.directory) as runs:
+            imba_merge = IMBAExportMerge(setup.imba_files, runs, run_size=args.run_size)
+            log.info()
+            log.info("-"*plen)
+            log.info()
+            all_members = MergedAllMembers(amba_members=amba_members, imba_members=imba_merge,
+                                           directory=setup.directory, fuzzy=args.fuzzy, compress=args.compress,
+                                           **output)
+    elif args.workers > 1:
+        # Both files share one process pool for their chunks
+        with concurrent.futures.ProcessPoolExecutor(args.workers) as pool, \
+             concurrent.futures.ThreadPoolExecutor(2) as threads:
+            amba_future = threads.submit(AMBAMembers, setup.amba_file, hashes=hashes, workers=args.workers, pool=pool,
+                                         cache=cache)
+            imba_future = threads.submit(IMBAMembers, setup.imba_file, hashes=hashes, workers=args.workers, pool=pool,
+                                         cache=cache)
+            amba_members = amba_future.result()
+            imba_members = imba_future.result()
+    else:
+        amba_members = AMBAMembers(setup.amba_file, hashes=hashes, cache=cache)
+        log.info()
+        log.info("-"*plen)
+        log.info()
+
+        imba_members = IMBAMembers(setup.imba_file, hashes=hashes, cache=cache)
+    if not merge and args.budget is None:
+        log.info()
+        log.info("-"*plen)
+        log.info()
+
+        all_members = AllMembers(amba_members=amba_members, imba_members=imba_members, directory=setup.directory,
+                                 fuzzy=args.fuzzy, state=state, compress=args.compress,
+                                 households=args.households, partition=args.partition_key, workers=args.workers,
+                                 **output)
+    if state is not None:
+        state.save(amba_members, imba_members, all_members.matches,
+                   set(member.membership_id for member in all_members.new_members))
+    if args.history_file:
+        history = History(os.path.abspath(args.history_file))
+        history.record(setup, amba_members, imba_members, all_members, started)
+        history.close()
+
+    metrics.save(os.path.join(setup.directory, "metrics.json"), started=started, amba_file=amba_file, \
+            imba_files=imba_files, options=vars(args))
+    log.info(" - Run metrics written to %s" % os.path.join(setup.directory, "metrics.json"))
+    if args.trace_memory:
+        tracemalloc.stop()
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(os.path.join(setup.directory, "profile.pstats"))
+        log.info(" - Profile written to %s" % os.path.join(setup.directory, "profile.pstats"))
+    if quarantine.count:
+        log.info(" - %s rejected rows written to %s" % (quarantine.count, os.path.join(setup.directory, "rejected.csv")))
+    log.info(" - Run log written to %s" % os.path.join(setup.directory, "itoa.log"))
+    log.info()
+    log.info("*"*plen)
+    log.info()
+    quarantine.close()
+    log.close()
+
+
+def query(argv=None):
+    """ Answer questions about past runs from the history database
+    """
+    parser = argparse.ArgumentParser(prog='itoa.py query', description='Query the history of past runs')
+    parser.add_argument('--history', dest='history_file', action='store', default='itoa_history.sqlite',
+                       metavar='HISTORY_FILE', help='History database (default itoa_history.sqlite)')
+    queries = parser.add_subparsers(dest='query', required=True)
+    first_new = queries.add_parser('first-new', help='When a member was first exported as new')
+    first_new.add_argument('member', help='Membership id or email')
+    timeline = queries.add_parser('member', help='What every run did with a member')
+    timeline.add_argument('member', help='Membership id or email')
+    per_month = queries.add_parser('per-month', help='Members first exported per month')
+    per_month.add_argument('export', nargs='?', default='new_all',
+                       choices=[os.path.splitext(name)[0] for name in AllMembers.OUTPUT_FILES],
+                       help='Output file to count (default new_all)')
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(args.history_file):
+        log.error("Error: History file %s not found." % args.history_file)
+        sys.exit(1)
+    history = History(args.history_file)
+
+    if args.query == 'first-new':
+        rows = history.first_new(args.member)
+        for member_id, run_date in rows:
+            print("%s first exported as new on %s" % (member_id, run_date))
+    elif args.query == 'member':
+        rows = history.timeline(args.member)
+        for started, member_id, result in rows:
+            print("%s %s %s" % (started, member_id, result))
+    else:
+        rows = history.added_per_month(args.export)
+        for month, count in rows:
+            print("%s %s" % (month, count))
+    if not rows:
+        print("Nothing recorded for %s" % (getattr(args, 'member', None) or args.export))
+    history.close()
+
+
+def serve(argv=None):
+    """ Keep the exports loaded and answer duplicate checks, as JSON lines
+        on stdin/stdout or over HTTP
+    """
+    parser = argparse.ArgumentParser(prog='itoa.py serve', description='Answer duplicate checks against '
+                                     'exports kept in memory')
+    parser.add_argument('-a', '--amba', dest='amba_file', action='store', required=True,
+                       help='AMBA membership file')
+    parser.add_argument('-i', '--imba', dest='imba_file', action='store', required=True,
+                       help='IMBA membership file')
+    parser.add_argument('--fuzzy', dest='fuzzy', action='store', type=fuzzy_threshold, nargs='?', const=0.85,
+                       metavar='THRESHOLD', help='Also match similar names (default threshold 0.85)')
+    parser.add_argument('--http', dest='port', action='store', type=int, nargs='?', const=8080,
+                       metavar='PORT', help='Serve HTTP on localhost instead of JSON lines on stdin/stdout '
+                                            '(default port 8080)')
+    parser.add_argument('--reload-interval', dest='interval', action='store', type=float, default=2.0,
+                       metavar='SECONDS', help='Reload the exports when their files change, checked this '
+                                               'often, 0 to only reload on request (default 2)')
+    parser.add_argument('-w', '--workers', dest='workers', action='store', type=int, default=1,
+                       help='Parse large files in chunks on this many processes (default 1)')
+    args = parser.parse_args(argv)
+
+    # Progress goes to stderr, stdout is only for responses
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    for fname in (args.amba_file, args.imba_file):
+        if not os.path.isfile(fname):
+            log.error("Error: %s not found." % fname)
+            sys.exit(1)
+    service = MatchService(args.amba_file, args.imba_file, fuzzy=args.fuzzy, workers=args.workers)
+    if args.interval > 0:
+        service.watch(args.interval)
+
+    if args.port is not None:
+        service.serve_http("127.0.0.1", args.port)
+    else:
+        service.serve_lines(sys.stdin, out)
+
+
+def watch(argv=None):
+    """ Run the exports dropped into a folder as they arrive
+    """
+    parser = argparse.ArgumentParser(prog='itoa.py watch', description='Watch a folder for new AMBA and IMBA '
+                                     'exports and run each new pair')
+    parser.add_argument('directory', action='store', help='Folder the exports are dropped into')
+    parser.add_argument('-o', '--output', dest='root', action='store', default=None,
+                       help='Where the dated output directories and the input archive go (default current directory)')
+    parser.add_argument('--interval', dest='interval', action='store', type=float, default=2.0,
+                       metavar='SECONDS', help='How often the folder is checked (default 2)')
+    parser.add_argument('--settle', dest='settle', action='store', type=float, default=5.0,
+                       metavar='SECONDS', help='How long a file must be left unmodified before it is '
+                                               'picked up (default 5)')
+    parser.add_argument('--once', dest='once', action='store_true',
+                       help='Handle the files already in the folder and exit')
+    parser.add_argument('--fuzzy', dest='fuzzy', action='store', type=fuzzy_threshold, nargs='?', const=0.85,
+                       metavar='THRESHOLD', help='Also match similar names (default threshold 0.85)')
+    parser.add_argument('--compress', dest='compress', action='store', choices=sorted(COMPRESSION),
+                       default=None, help='Write the new_*.csv files compressed (.gz, .bz2 or .xz)')
+    parser.add_argument('-w', '--workers', dest='workers', action='store', type=int, default=1,
+                       help='Parse large files in chunks on this many processes (default 1)')
+    add_log_arguments(parser)
+    add_quarantine_arguments(parser)
+    args = parser.parse_args(argv)
+    log.level = args.log_level
+    quarantine.max_rejects = args.max_rejects
+    quarantine.max_rate = args.max_reject_rate
+
+    if not os.path.isdir(args.directory):
+        log.error("Error: %s is not a directory." % args.directory)
+        sys.exit(1)
+    folder = WatchFolder(args.directory, args.root or os.getcwd(), settle=args.settle, fuzzy=args.fuzzy,
+                         compress=args.compress, workers=args.workers)
+    folder.watch(args.interval, once=args.once)
+
+
+COMMANDS = {"query": query, "serve": serve, "watch": watch} # Subcommands, anything else is a run
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    return run(argv)
 
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+""" Tests for itoa.py, run with python -m unittest or pytest
+"""
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import itoa
+
+
+def write_export(fname, header, rows):
+    with open(fname, 'w', newline='', encoding='utf-8') as fd:
+        writer = csv.writer(fd)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def member_values(members):
+    """ Every member's fields, in file order
+    """
+    return [[getattr(member, name) for name in member.fields()] for member in members.members.values()]
+
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        level, itoa.log.level = itoa.log.level, itoa.Log.QUIET
+        self.addCleanup(setattr, itoa.log, "level", level)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+class ChunkedParseTest(ExportTestCase):
+    """ Parsing in chunks on a process pool gives the same members and
+        rejects as parsing the file serially
+    """
+    def amba_rows(self, count):
+        rows = list()
+        for i in range(count):
+            street = "%s Oak St" % i
+            if i % 97 == 5:
+                street = '12" Oak St' # A quote inside an unquoted field is text
+            elif i % 89 == 7:
+                street = "Apt %s\nOak St, Rear" % i # Quoted, with a newline and a comma
+            first = 'Robert "Bob"' if i % 83 == 3 else "Ann%s" % i
+            rows.append(["%s" % (10000000 + i), first, "Lee%s" % i, "ann%s@example.com" % i, "303-555-%04d" % i,
+                         "No", street, "Salida", "CO", "81201", "1/2/2024", "5", "0"])
+        return rows
+
+    def parse(self, fname, workers):
+        with mock.patch.object(itoa.Members, "CHUNK_SIZE", 4096):
+            return itoa.AMBAMembers(fname, hashes=True, workers=workers)
+
+    def test_stray_quotes(self):
+        fname = self.path("amba.csv")
+        rows = self.amba_rows(3000)
+        # Stray quotes written as is, as some exports do
+        with open(fname, 'w', newline='', encoding='utf-8') as fd:
+            writer = csv.writer(fd)
+            writer.writerow(itoa.AMBAMembers.REQUIRED_FIELDS)
+            for row in rows:
+                if row[6].startswith('12"'):
+                    fd.write(",".join(row) + "\r\n")
+                else:
+                    writer.writerow(row)
+
+        serial = self.parse(fname, 1)
+        chunked = self.parse(fname, 4)
+        self.assertEqual(len(serial.members), len(rows))
+        self.assertEqual(member_values(chunked), member_values(serial))
+        self.assertEqual(chunked.hashes, serial.hashes)
+        self.assertEqual(chunked._rejected, serial._rejected)
+
+    def test_unit_separator_in_fields(self):
+        fname = self.path("amba.csv")
+        rows = self.amba_rows(3000)
+        rows[10][6] = "12\x1f Oak St"
+        rows[2500][1] = "Ann\x1f"
+        write_export(fname, itoa.AMBAMembers.REQUIRED_FIELDS, rows)
+
+        serial = self.parse(fname, 1)
+        self.assertEqual(len(serial.members), len(rows))
+        self.assertEqual(serial.members["10000010"].street, "12\x1f Oak St")
+        self.assertEqual(member_values(self.parse(fname, 4)), member_values(serial))
+
+        cache = itoa.SnapshotCache(self.path("snapshots"), itoa.InputArchive(self.path("archive")))
+        itoa.AMBAMembers(fname, hashes=True, cache=cache) # Parsed and stored
+        cached = itoa.AMBAMembers(fname, hashes=True, cache=cache)
+        self.assertEqual(member_values(cached), member_values(serial))
+        self.assertEqual(cached.hashes, serial.hashes)
+
+    def test_boundaries_follow_csv_quoting(self):
+        fname = self.path("quotes.csv")
+        with open(fname, 'w', newline='') as fd:
+            fd.write('a,b\n')
+            fd.write('12" Oak,"x\n')   # Stray quote, then a quoted field with a newline
+            fd.write('y",z\n')
+            fd.write('"p""q",r\n')
+            fd.write('s,"t\n\nu"\n')
+            fd.write('v,w\n')
+        with open(fname, newline='') as fd:
+            expected = list(csv.reader(fd))[1:]
+
+        for chunks in range(2, 12):
+            bounds = itoa.record_boundaries(fname, 4, chunks)
+            rows = list()
+            with open(fname, 'rb') as fd:
+                data = fd.read()
+            for start, end in zip(bounds, bounds[1:]):
+                rows.extend(csv.reader(data[start:end].decode().splitlines(True)))
+            self.assertEqual(rows, expected, "split at %s" % bounds)
+
+
+class PartitionedMatcherTest(ExportTestCase):
+    """ Matching out of core finds the same duplicates as the AMBA index
+    """
+    def amba_row(self, member_id, first, last, email):
+        return [member_id, first, last, email, "303-555-0100", "No", "1 Oak St", "Salida", "CO", "81201",
+                "1/2/2024", "5", "0"]
+
+    def imba_row(self, member_id, first, last, email):
+        return ["C%s" % member_id, first, last, "1 Oak St", "Salida", "CO", "81201", email, "303-555-0100",
+                member_id, "Individual", "Year", "No", "1/2/2024", "1/2/2024", "12/31/2025", "1/2/2024", "5",
+                "Current", "0"]
+
+    def test_same_matches_as_index(self):
+        amba = [
+            self.amba_row("10000001", "Ann", "Lee", "ann@example.com"),
+            self.amba_row("10000002", "Bob", "Ray", "ANN@example.com"),   # Repeated email, 10000001 wins
+            self.amba_row("10000003", "ann", "LEE", "lee@example.com"),   # Repeated name, 10000001 wins
+            self.amba_row("10000004", "", "", ""),                        # Empty keys match nothing
+            self.amba_row("10000005", "Cy", "Dee", "cy@example.com"),
+            self.amba_row("10000006", "Di", "Fay", "di@example.com"),
+        ]
+        amba += [self.amba_row(str(20000000 + i), "First%s" % i, "Last%s" % (i % 50), "m%s@example.com" % i)
+                 for i in range(300)]
+        imba = [
+            self.imba_row("10000002", "Zed", "Zed", "ann@example.com"),  # Id before email
+            self.imba_row("50000001", "Eve", "Orr", " Ann@Example.com"),  # Email, first AMBA row wins
+            self.imba_row("50000002", "ANN", "lee", "new@example.com"),  # Name, first AMBA row wins
+            self.imba_row("50000003", "", "", ""),                       # Empty keys
+            self.imba_row("50000004", "Cy", "Dee", "x@example.com"),     # Superseded by the row below
+            self.imba_row("50000005", "Di", "Fay", "y@example.com"),
+            self.imba_row("50000004", "Gus", "Hay", "gus@example.com"),
+            self.imba_row("50000006", "Ida", "Jo", "ida@example.com"),   # Superseded, then matches
+            self.imba_row("50000005", "Kim", "Lam", "kim@example.com"),  # Replaces a match with none
+            self.imba_row("50000006", "Ida", "Jo", "di@example.com"),
+        ]
+        imba += [self.imba_row(str(60000000 + i), "First%s" % i, "Last%s" % (i % 50),
+                               "m%s@example.com" % (i * 7) if i % 3 else "n%s@example.com" % i)
+                 for i in range(300)]
+        amba_file, imba_file = self.path("amba.csv"), self.path("imba.csv")
+        write_export(amba_file, itoa.AMBAMembers.REQUIRED_FIELDS, amba)
+        write_export(imba_file, itoa.IMBAMembers.REQUIRED_FIELDS, imba)
+
+        expected = itoa.AllMembers(itoa.AMBAMembers(amba_file), itoa.IMBAMembers(imba_file),
+                                   self.path("")).matches
+        os.makedirs(self.path("spill"))
+        # A budget of 0 MB puts every partition over it, so each one is split
+        matcher = itoa.PartitionedMatcher(itoa.AMBAMembers.stream(amba_file), itoa.IMBAMembers.stream(imba_file),
+                                          self.path("spill"), budget_mb=0)
+        self.assertGreater(matcher._splits, 0)
+        self.assertEqual(matcher.matches, expected)
+
+        self.assertEqual(expected["10000002"], ("id", "10000002"))
+        self.assertEqual(expected["50000001"], ("email", "10000001"))
+        self.assertEqual(expected["50000002"], ("name", "10000001"))
+        self.assertEqual(expected["50000006"], ("email", "10000006"))
+        for member_id in ("50000003", "50000004", "50000005"):
+            self.assertNotIn(member_id, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()